@@ -0,0 +1,51 @@
+"""
+Benchmark of slash command acknowledgement.
+
+Slack gives up on a slash command which is not answered within 3 seconds.  "list all" is run against stubbed provider
+endpoints with every defer mode of cloudmaster: "none" answers once the command is done, "thread" and "dispatch"
+acknowledge right away and run the command in a background thread or in a non-blocking Dispatch run.  Reports the
+time to acknowledge and the time until the summary was posted to slack.
+
+Usage:
+    python benchmarks/ack.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import cloudmaster  # noqa: E402
+from fakes import FakeDispatch  # noqa: E402
+
+LATENCIES = {'aws': 0.4, 'azure': 0.8, 'gcp': 0.3, 'vsphere': 3.5}
+OUTPUT = [{'name': 'vm-1', 'id': '1', 'status': 'running'}]
+
+
+def summary_posted(fake, after):
+    return any(message.get('attachments', [{}])[0].get('title', '').endswith('finished')
+               for message in fake.messages[after:])
+
+
+def main():
+    functions = {cloudmaster.LIST_FUNCTIONS.get(c, c): latency for c, latency in LATENCIES.items()}
+    outputs = {f: OUTPUT for f in functions}
+    with FakeDispatch(functions, outputs) as fake:
+        print("%-10s %12s %12s" % ("defer", "ack", "summary"))
+        for mode in (cloudmaster.DEFER_NONE, cloudmaster.DEFER_THREAD, cloudmaster.DEFER_DISPATCH):
+            ctx = {'secrets': {'url': fake.url, 'defer': mode, 'inventory': {'ttl': 0, 'maxStale': 0}}}
+            outputs[cloudmaster.FUNCTION_NAME] = lambda data, ctx=ctx: cloudmaster.handle(ctx, data['input'])
+            payload = {'text': 'list all', 'response_url': fake.slack_url, 'trigger_id': 'trigger-' + mode}
+
+            seen = len(fake.messages)
+            start = time.time()
+            cloudmaster.handle(ctx, payload)
+            ack = time.time() - start
+            while not summary_posted(fake, seen):
+                time.sleep(0.01)
+            print("%-10s %11.3fs %11.2fs" % (mode, ack, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
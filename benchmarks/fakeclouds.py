@@ -0,0 +1,507 @@
+"""
+Local stand-ins for the cloud SDKs used by the provider functions.
+
+install() puts fake boto3, googleapiclient (with google-auth), azure (with msrestazure) modules into sys.modules, so
+the provider modules import them instead of the real SDKs, and connect() logs into a fake vCenter for the vSphere
+session pool (pyVmomi itself is used for its data types only).  Every fake cloud serves an inventory of `vms`
+instances managed by cloudmaster and sleeps `latency` seconds per API call (a call per page for listings), nothing
+goes over the network.
+"""
+
+import itertools
+import sys
+import threading
+import time
+import types
+from collections import namedtuple
+
+from pyVmomi import vim
+
+
+# regions (AWS) and zones (GCP) of the fake clouds
+REGIONS = ['us-west-2', 'us-west-1', 'us-east-1', 'us-east-2', 'eu-west-1', 'ap-southeast-1']
+ZONES = ['us-west1-a', 'us-west1-b', 'us-east1-b', 'us-east1-c', 'europe-west1-b', 'asia-east1-a']
+
+
+class FakeCloud(object):
+    """Inventory size (per region or zone) and API latency of a fake cloud, both can be changed at any time"""
+
+    def __init__(self, name, vms=100, latency=0.0, page_size=500):
+        self.name = name
+        self.vms = vms
+        self.latency = latency
+        self.page_size = page_size
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def new_id(self):
+        return next(self._ids)
+
+    def pages(self, make, page_size=None):
+        """Yields the inventory as pages of make(i) items, a call per page"""
+
+        page_size = page_size or self.page_size
+        for start in range(0, self.vms, page_size) or [0]:
+            self.call()
+            yield [make(i) for i in range(start, min(start + page_size, self.vms))]
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+class _Poller(object):
+    """Azure-like operation poller, done after the cloud's latency.  Like msrest's LROPoller, done callbacks get the
+    polling method (not the poller) and are called right away, without raising, once the poller is done"""
+
+    def __init__(self, cloud, result=None):
+        self._result = result
+        self._polling_method = object()
+        self._done = threading.Event()
+        self._callbacks = []
+        timer = threading.Timer(cloud.latency, self._finish)
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self):
+        self._done.set()
+        for callback in self._callbacks:
+            callback(self._polling_method)
+
+    def add_done_callback(self, func):
+        if self._done.is_set():
+            func(self._polling_method)
+        self._callbacks.append(func)
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        self._done.wait(timeout)
+        return self._result
+
+
+# AWS
+
+class _EC2Instance(object):
+
+    def __init__(self, cloud, i, name=None, state='running'):
+        self._cloud = cloud
+        self.id = 'i-%08x' % i
+        self.tags = [{'Key': 'managedby', 'Value': 'cloudmaster'}, {'Key': 'Name', 'Value': name or 'vm-%d' % i}]
+        self.state = {'Name': state}
+
+
+class _EC2Instances(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def filter(self, Filters=None):
+        names = [v for f in Filters or [] if f['Name'] == 'tag:Name' for v in f['Values']]
+        if names:
+            self._cloud.call()
+            return [_EC2Instance(self._cloud, i + 1, name) for i, name in enumerate(names)]
+        return itertools.chain.from_iterable(self._cloud.pages(lambda i: _EC2Instance(self._cloud, i)))
+
+
+class _EC2Client(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+        self._tokens = {}
+
+    def get_paginator(self, name):
+        return _EC2Paginator(self._cloud)
+
+    def run_instances(self, MinCount, MaxCount, ClientToken=None, **kwargs):
+        if ClientToken in self._tokens:
+            return {'Instances': self._tokens[ClientToken]}
+        self._cloud.call()
+        instances = [{'InstanceId': 'i-%08x' % self._cloud.new_id(), 'State': {'Name': 'pending'}}
+                     for _ in range(MaxCount)]
+        if ClientToken:
+            self._tokens[ClientToken] = instances
+        return {'Instances': instances}
+
+    def describe_regions(self):
+        self._cloud.call()
+        return {'Regions': [{'RegionName': region} for region in REGIONS]}
+
+    def terminate_instances(self, InstanceIds):
+        self._cloud.call()
+        return {'TerminatingInstances': [{'InstanceId': i, 'CurrentState': {'Name': 'shutting-down'}}
+                                         for i in InstanceIds]}
+
+    def describe_instances(self, InstanceIds=None, **kwargs):
+        self._cloud.call()
+        return {'Reservations': [{'Instances': [{'InstanceId': i, 'State': {'Name': 'running'}}
+                                                for i in InstanceIds or []]}]}
+
+
+class _EC2Paginator(object):
+    """describe_instances paginator, every page is a reservation of up to PageSize instances"""
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def paginate(self, Filters=None, PaginationConfig=None):
+        def make(i):
+            return {'InstanceId': 'i-%08x' % i, 'State': {'Name': 'running'},
+                    'Tags': [{'Key': 'managedby', 'Value': 'cloudmaster'}, {'Key': 'Name', 'Value': 'vm-%d' % i}]}
+
+        for page in self._cloud.pages(make, (PaginationConfig or {}).get('PageSize')):
+            yield {'Reservations': [{'Instances': page}]}
+
+
+class _EC2Resource(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+        self.instances = _EC2Instances(cloud)
+        self.meta = types.SimpleNamespace(client=_EC2Client(cloud))
+
+
+def boto3_module(cloud):
+    resource = _EC2Resource(cloud)
+
+    class Session(object):
+        def __init__(self, **kwargs):
+            pass
+
+        def resource(self, name):
+            return resource
+
+        def client(self, name):
+            return resource.meta.client
+
+    session = _module('boto3.session', Session=Session)
+    return {'boto3': _module('boto3', session=session), 'boto3.session': session}
+
+
+# GCP
+
+class _Request(object):
+
+    def __init__(self, cloud, func):
+        self._cloud = cloud
+        self._func = func
+
+    def execute(self, http=None):
+        self._cloud.call()
+        return self._func()
+
+
+def _gcp_instance(zone, i):
+    return {'id': str(i), 'name': 'vm-%d' % i, 'status': 'RUNNING', 'zone': zone, 'labels': {'managedby': 'cloudmaster'}}
+
+
+class _Instances(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def _page(self, zone, start):
+        end = min(start + self._cloud.page_size, self._cloud.vms)
+        page = {'items': [_gcp_instance(zone, i) for i in range(start, end)]}
+        if end < self._cloud.vms:
+            page['nextPageToken'] = str(end)
+        return page
+
+    def list(self, project, zone, filter=None, pageToken=None, maxResults=None):
+        request = _Request(self._cloud, lambda: self._page(zone, int(pageToken or 0)))
+        request.zone = zone
+        return request
+
+    def list_next(self, previous_request, previous_response):
+        token = previous_response.get('nextPageToken')
+        if not token:
+            return None
+        return self.list(None, previous_request.zone, pageToken=token)
+
+    def aggregatedList(self, project, filter=None, pageToken=None, maxResults=None):
+        request = _Request(self._cloud, lambda: self._aggregated_page(int(pageToken or 0), maxResults))
+        request.max_results = maxResults
+        return request
+
+    def _aggregated_page(self, start, page_size):
+        """A page of the inventories of all ZONES, zones without instances on the page only carry a warning"""
+
+        total = self._cloud.vms * len(ZONES)
+        end = min(start + (page_size or self._cloud.page_size), total)
+        items = {'zones/%s' % zone: {'warning': {'code': 'NO_RESULTS_ON_PAGE'}} for zone in ZONES}
+        for i in range(start, end):
+            zone = ZONES[i // self._cloud.vms]
+            items['zones/%s' % zone].setdefault('instances', []).append(_gcp_instance(zone, i))
+        response = {'items': items}
+        if end < total:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def aggregatedList_next(self, previous_request, previous_response):
+        token = previous_response.get('nextPageToken')
+        if not token:
+            return None
+        return self.aggregatedList(None, pageToken=token, maxResults=previous_request.max_results)
+
+    def insert(self, project, zone, body, requestId=None):
+        return _Request(self._cloud, lambda: {'name': 'operation-%s' % (requestId or self._cloud.new_id())})
+
+    def delete(self, project, zone, instance, requestId=None):
+        return _Request(self._cloud, lambda: {'name': 'operation-%d' % self._cloud.new_id()})
+
+
+class _Batch(object):
+
+    def __init__(self, cloud, callback):
+        self._cloud = cloud
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self._requests.append((request_id, request, callback or self._callback))
+
+    def execute(self, http=None):
+        if len(self._requests) > 1000:
+            raise ValueError("Exceeded maximum number of requests in a batch")
+        self._cloud.call()
+        for request_id, request, callback in self._requests:
+            callback(request_id, request._func(), None)
+
+
+class _Compute(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+        self._instances = _Instances(cloud)
+
+    def instances(self):
+        return self._instances
+
+    def images(self):
+        cloud = self._cloud
+        return types.SimpleNamespace(getFromFamily=lambda project, family: _Request(
+            cloud, lambda: {'selfLink': 'projects/%s/global/images/%s-v1' % (project, family)}))
+
+    def machineTypes(self):
+        cloud = self._cloud
+        return types.SimpleNamespace(get=lambda project, zone, machineType: _Request(
+            cloud, lambda: {'selfLink': 'projects/%s/zones/%s/machineTypes/%s' % (project, zone, machineType)}))
+
+    def networks(self):
+        cloud = self._cloud
+        return types.SimpleNamespace(get=lambda project, network: _Request(
+            cloud, lambda: {'selfLink': 'projects/%s/global/networks/%s' % (project, network)}))
+
+    def zoneOperations(self):
+        cloud = self._cloud
+        return types.SimpleNamespace(get=lambda project, zone, operation: _Request(
+            cloud, lambda: {'name': operation, 'status': 'DONE'}))
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self._cloud, callback)
+
+
+def googleapiclient_modules(cloud):
+    compute = _Compute(cloud)
+
+    class Credentials(object):
+        @classmethod
+        def from_service_account_info(cls, info):
+            return cls()
+
+    service_account = _module('google.oauth2.service_account', Credentials=Credentials)
+    discovery = _module('googleapiclient.discovery', build=lambda *args, **kwargs: compute)
+    return {
+        'googleapiclient': _module('googleapiclient', discovery=discovery),
+        'googleapiclient.discovery': discovery,
+        'google_auth_httplib2': _module('google_auth_httplib2', AuthorizedHttp=lambda credentials: object()),
+        'google': _module('google', oauth2=_module('google.oauth2', service_account=service_account)),
+        'google.oauth2': _module('google.oauth2', service_account=service_account),
+        'google.oauth2.service_account': service_account,
+    }
+
+
+# Azure
+
+AzureVM = namedtuple('AzureVM', ['id', 'name', 'provisioning_state', 'tags'])
+# the fields of GenericResource in azure-mgmt-resource 2.0.0 (installed by azure==4.0.0)
+AzureResource = namedtuple('AzureResource', ['id', 'name', 'type', 'location', 'tags', 'properties'])
+
+
+def _azure_vm(i):
+    return AzureVM('/vms/vm-%d' % i, 'vm-%d' % i, 'Succeeded', {'managedby': 'cloudmaster'})
+
+
+def _azure_resource(i):
+    return AzureResource('/vms/vm-%d' % i, 'vm-%d' % i, 'Microsoft.Compute/virtualMachines', 'westus',
+                         {'managedby': 'cloudmaster'}, None)
+
+
+class _Operations(object):
+    """create_or_update/delete/get/list of an Azure resource type"""
+
+    def __init__(self, cloud, make=None):
+        self._cloud = cloud
+        self._make = make
+
+    def list(self, *args, **kwargs):
+        return itertools.chain.from_iterable(self._cloud.pages(self._make))
+
+    def get(self, *args):
+        self._cloud.call()
+        return types.SimpleNamespace(id='/'.join(args))
+
+    def create_or_update(self, resource_group, name, parameters):
+        self._cloud.call()
+        return _Poller(self._cloud, types.SimpleNamespace(id='/%s/%s' % (resource_group, name), name=name))
+
+    def delete(self, resource_group, name):
+        self._cloud.call()
+        return _Poller(self._cloud)
+
+
+def azure_modules(cloud):
+
+    class CloudError(Exception):
+        pass
+
+    def compute_client(credentials, subscription):
+        return types.SimpleNamespace(virtual_machines=_Operations(cloud, _azure_vm))
+
+    def network_client(credentials, subscription):
+        return types.SimpleNamespace(subnets=_Operations(cloud), network_interfaces=_Operations(cloud))
+
+    def resource_client(credentials, subscription):
+        return types.SimpleNamespace(resources=_Operations(cloud, _azure_resource))
+
+    credentials = _module('azure.common.credentials', ServicePrincipalCredentials=lambda **kwargs: object())
+    network = _module('azure.mgmt.network', NetworkManagementClient=network_client)
+    compute = _module('azure.mgmt.compute', ComputeManagementClient=compute_client)
+    resource = _module('azure.mgmt.resource', ResourceManagementClient=resource_client)
+    exceptions = _module('msrestazure.azure_exceptions', CloudError=CloudError)
+    return {
+        'azure': _module('azure'),
+        'azure.common': _module('azure.common', credentials=credentials),
+        'azure.common.credentials': credentials,
+        'azure.mgmt': _module('azure.mgmt', network=network, compute=compute, resource=resource),
+        'azure.mgmt.network': network,
+        'azure.mgmt.compute': compute,
+        'azure.mgmt.resource': resource,
+        'msrestazure': _module('msrestazure', azure_exceptions=exceptions),
+        'msrestazure.azure_exceptions': exceptions,
+    }
+
+
+# vSphere
+
+Property = namedtuple('Property', ['name', 'val'])
+ObjectContent = namedtuple('ObjectContent', ['obj', 'propSet'])
+RetrieveResult = namedtuple('RetrieveResult', ['objects', 'token'])
+
+
+class _Stub(object):
+    """SOAP stub of managed objects of the fake vCenter, answers method calls and property reads"""
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def InvokeMethod(self, mo, info, args):
+        self._cloud.call()
+        if info.name in ('Clone', 'Destroy'):
+            return vim.Task('task-%d' % self._cloud.new_id(), self)
+        return None
+
+    def InvokeAccessor(self, mo, info):
+        self._cloud.call()
+        if info.name == 'info':
+            return types.SimpleNamespace(state=vim.TaskInfo.State.success, error=None)
+        if info.name == 'datastore':
+            return [vim.Datastore('datastore-1')]
+        if info.name == 'vmFolder':
+            return vim.Folder('group-v1')
+        return None
+
+
+class _PropertyCollector(object):
+
+    def __init__(self, cloud, stub):
+        self._cloud = cloud
+        self._stub = stub
+        self._page_size = None
+
+    def _vm(self, i):
+        return ObjectContent(vim.VirtualMachine('vm-%d' % i, self._stub), [
+            Property('summary.config.name', 'vm-%d' % i),
+            Property('summary.config.instanceUuid', 'uuid-%d' % i),
+            Property('runtime.powerState', 'poweredOn'),
+        ])
+
+    def _page(self, offset):
+        self._cloud.call()
+        end = min(offset + self._page_size, self._cloud.vms)
+        objects = [self._vm(i) for i in range(offset, end)]
+        return RetrieveResult(objects, str(end) if end < self._cloud.vms else None)
+
+    def RetrievePropertiesEx(self, specs, options):
+        self._page_size = options.maxObjects
+        return self._page(0)
+
+    def ContinueRetrievePropertiesEx(self, token):
+        return self._page(int(token))
+
+    def CancelRetrievePropertiesEx(self, token):
+        self._cloud.call()
+
+    def RetrieveContents(self, specs):
+        # names of the inventory index: the cloudmaster template and the placement objects
+        self._cloud.call()
+        return [
+            ObjectContent(vim.VirtualMachine('vm-template', self._stub), [Property('name', 'dispatch-photon')]),
+            ObjectContent(vim.Datacenter('datacenter-1', self._stub), [Property('name', 'dc')]),
+            ObjectContent(vim.Folder('group-v1', self._stub), [Property('name', 'vm')]),
+            ObjectContent(vim.ResourcePool('resgroup-1', self._stub), [Property('name', 'Resources')]),
+        ]
+
+
+class FakeVCenter(object):
+    """Connect and disconnect functions for the vSphere session pool"""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self._stub = _Stub(cloud)
+
+    def connect(self, **kwargs):
+        self.cloud.call()
+        content = types.SimpleNamespace(
+            propertyCollector=_PropertyCollector(self.cloud, self._stub),
+            viewManager=types.SimpleNamespace(
+                CreateContainerView=lambda folder, types, recursive: vim.view.ContainerView('view-1', self._stub)),
+            rootFolder=vim.Folder('group-d1', self._stub),
+            sessionManager=types.SimpleNamespace(currentSession=object()),
+        )
+        return types.SimpleNamespace(RetrieveContent=lambda: content)
+
+    def disconnect(self, si):
+        pass
+
+
+def install(clouds):
+    """Puts the fake SDK modules of clouds ({name: FakeCloud}) into sys.modules. Must be called before the provider
+    modules are imported"""
+
+    if 'aws' in clouds:
+        sys.modules.update(boto3_module(clouds['aws']))
+    if 'gcp' in clouds:
+        sys.modules.update(googleapiclient_modules(clouds['gcp']))
+    if 'azure' in clouds:
+        sys.modules.update(azure_modules(clouds['azure']))
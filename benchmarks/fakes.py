@@ -0,0 +1,109 @@
+"""
+Local stand-ins for the services cloudmaster talks to.
+
+FakeDispatch serves POST /v1/runs?functionName=<cloud> (sleeping for the configured per-cloud latency before answering
+with a canned output) and POST /slack, which records every message posted to a slack response_url.  Non-blocking runs
+are answered right away, their output (if it is a function) is computed in the background.  Faults can be injected
+(and changed while the server runs) with latencies (a hung function is a large latency) and statuses, the HTTP status
+a function's runs fail with.  slack_rate limits posts to /slack per second, like slack's webhooks: posts beyond it
+are answered with 429 and a Retry-After header.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDispatch(object):
+    """Fake Dispatch API server and slack sink running on a local port"""
+
+    def __init__(self, latencies=None, outputs=None, statuses=None, slack_rate=None):
+        self.latencies = latencies or {}
+        self.outputs = outputs or {}
+        self.statuses = statuses or {}
+        self.slack_rate = slack_rate
+        self.rate_limited = 0
+        self._slack_times = []
+        self.runs = []
+        self.messages = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    @property
+    def slack_url(self):
+        return self.url + "/slack"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                data = json.loads(body.decode('utf-8')) if body else {}
+                if parsed.path == '/slack':
+                    with fake._lock:
+                        now = time.time()
+                        fake._slack_times = [t for t in fake._slack_times if t > now - 1]
+                        if fake.slack_rate is not None and len(fake._slack_times) >= fake.slack_rate:
+                            fake.rate_limited += 1
+                            return self._reply(429, 'rate_limited', {'Retry-After': '1'})
+                        fake._slack_times.append(now)
+                        fake.messages.append(data)
+                    return self._reply(200, 'ok')
+                if parsed.path == '/v1/runs':
+                    cloud = parse_qs(parsed.query).get('functionName', [''])[0]
+                    with fake._lock:
+                        fake.runs.append((cloud, data))
+                    if not data.get('blocking', True):
+                        output = fake.outputs.get(cloud)
+                        if callable(output):
+                            thread = threading.Thread(target=output, args=(data,))
+                            thread.daemon = True
+                            thread.start()
+                        return self._reply(202, json.dumps({'status': 'INITIALIZED'}))
+                    time.sleep(fake.latencies.get(cloud, 0))
+                    if cloud in fake.statuses:
+                        return self._reply(fake.statuses[cloud], 'injected fault')
+                    output = fake.outputs.get(cloud, [])
+                    if callable(output):
+                        output = output(data)
+                    return self._reply(200, json.dumps({'status': 'READY', 'output': output}))
+                self._reply(404, 'not found')
+
+            def _reply(self, code, text, headers=None):
+                body = text.encode('utf-8')
+                self.send_response(code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
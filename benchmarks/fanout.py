@@ -0,0 +1,48 @@
+"""
+Benchmark of "all" commands against stubbed provider endpoints.
+
+Every cloud answers after a fixed latency.  With the concurrent fan-out the wall time of "list all" should be close to
+the slowest cloud (max) instead of the sum of all clouds.
+
+Usage:
+    python benchmarks/fanout.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import cloudmaster  # noqa: E402
+from fakes import FakeDispatch  # noqa: E402
+
+LATENCIES = {'aws': 0.4, 'azure': 0.8, 'gcp': 0.3, 'vsphere': 1.2}
+OUTPUT = [{'name': 'vm-1', 'id': '1', 'status': 'running'}]
+
+
+def main():
+    # list runs go to the functions answering list for each cloud
+    functions = {cloudmaster.LIST_FUNCTIONS.get(c, c): latency for c, latency in LATENCIES.items()}
+    with FakeDispatch(functions, {f: OUTPUT for f in functions}) as fake:
+        # no inventory caching, every list goes to the clouds
+        secrets = {'url': fake.url, 'inventory': {'ttl': 0, 'maxStale': 0}}
+        payload = {'text': 'list all', 'response_url': fake.slack_url}
+
+        start = time.time()
+        for cloud in cloudmaster.CLOUDS:
+            cloudmaster.list_vm(secrets, payload['response_url'], cloud)
+        sequential = time.time() - start
+
+        start = time.time()
+        cloudmaster.list_instances(secrets, payload, {'cloud': 'all', 'filters': {}})
+        concurrent = time.time() - start
+
+    print("sum(latencies): %.2fs" % sum(LATENCIES.values()))
+    print("max(latencies): %.2fs" % max(LATENCIES.values()))
+    print("sequential:     %.2fs" % sequential)
+    print("fan-out:        %.2fs" % concurrent)
+
+
+if __name__ == "__main__":
+    main()
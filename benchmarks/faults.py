@@ -0,0 +1,122 @@
+"""
+Fault injection against cloudmaster's circuit breakers and adaptive timeouts.
+
+Runs scenarios against a local fake Dispatch with injected faults (hung functions, 5xx errors, latency spikes) and
+checks that cloudmaster fails fast once a cloud is degraded, recovers once it is healthy again, and derives timeouts
+from observed latencies.  Exits with a non-zero status if a scenario fails.
+
+Usage:
+    python benchmarks/faults.py
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import breaker  # noqa: E402
+import cloudmaster  # noqa: E402
+import transport  # noqa: E402
+from fakes import FakeDispatch  # noqa: E402
+
+OUTPUT = [{'name': 'vm-1', 'id': '1', 'status': 'running'}]
+
+SETTINGS = {'failures': 3, 'resetTimeout': 1, 'minSamples': 5, 'minTimeout': 0.2, 'timeoutFactor': 3}
+
+
+def fetch(secrets, cloud):
+    """Returns (error or None, elapsed seconds) of listing a cloud"""
+
+    start = time.time()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            cloudmaster.fetch_vms(secrets, cloud)
+    except Exception as e:
+        return e, time.time() - start
+    return None, time.time() - start
+
+
+def hung_cloud(fake, secrets):
+    fake.latencies['vsphere-inventory'] = 10
+    results = [fetch(secrets, 'vsphere') for _ in range(SETTINGS['failures'])]
+    assert all(error is not None for error, _ in results), results
+    error, elapsed = fetch(secrets, 'vsphere')
+    assert isinstance(error, breaker.BreakerOpen), error
+    assert elapsed < 0.05, elapsed
+    return "%d timeouts of %.1fs, then failed fast in %.1fms" % (len(results), results[-1][1], elapsed * 1000)
+
+
+def recovery(fake, secrets):
+    hung_cloud(fake, secrets)
+    fake.latencies['vsphere-inventory'] = 0
+    time.sleep(SETTINGS['resetTimeout'])
+    assert breaker.get('vsphere').state == breaker.HALF_OPEN
+    error, _ = fetch(secrets, 'vsphere')
+    assert error is None, error
+    assert breaker.get('vsphere').state == breaker.CLOSED
+    return "half-open probe succeeded, breaker closed"
+
+
+def failing_cloud(fake, secrets):
+    fake.statuses['azure'] = 503
+    results = [fetch(secrets, 'azure') for _ in range(SETTINGS['failures'])]
+    assert all(error is not None for error, _ in results), results
+    error, elapsed = fetch(secrets, 'azure')
+    assert isinstance(error, breaker.BreakerOpen), error
+    return "%d errors, then failed fast in %.1fms" % (len(results), elapsed * 1000)
+
+
+def adaptive_timeout(fake, secrets):
+    secrets = dict(secrets, timeout=5)
+    fake.latencies['gcp'] = 0.05
+    for _ in range(SETTINGS['minSamples'] * 2):
+        error, _ = fetch(secrets, 'gcp')
+        assert error is None, error
+    timeout = breaker.get('gcp').timeout('list', cloudmaster.cloud_timeout(secrets))
+    fake.latencies['gcp'] = 3
+    error, elapsed = fetch(secrets, 'gcp')
+    assert error is not None
+    assert elapsed < 1, elapsed
+    return "p99 %.0fms, timeout %.1fs (limit %.0fs), spike timed out after %.1fs" % (
+        breaker.get('gcp').percentile('list', 99) * 1000, timeout, cloudmaster.cloud_timeout(secrets), elapsed)
+
+
+def degraded_all(fake, secrets):
+    hung_cloud(fake, secrets)
+    seen = len(fake.messages)
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cloudmaster.list_instances(secrets, {'response_url': fake.slack_url}, {'cloud': 'all', 'filters': {}})
+    elapsed = time.time() - start
+    texts = [a.get('text', '') for m in fake.messages[seen:] for a in m.get('attachments', [])]
+    assert any('degraded' in text for text in texts), texts
+    assert elapsed < 1, elapsed
+    return "list all answered in %.2fs with vsphere degraded" % elapsed
+
+
+SCENARIOS = [hung_cloud, recovery, failing_cloud, adaptive_timeout, degraded_all]
+
+
+def main():
+    functions = {cloudmaster.LIST_FUNCTIONS.get(c, c) for c in cloudmaster.CLOUDS}
+    failed = 0
+    for scenario in SCENARIOS:
+        breaker.reset()
+        breaker.configure(**SETTINGS)
+        # 5xx responses are not retried, each one counts as a failure
+        transport.configure(retries=0)
+        with FakeDispatch(outputs={f: OUTPUT for f in functions}) as fake:
+            secrets = {'url': fake.url, 'timeout': 0.5, 'inventory': {'ttl': 0, 'maxStale': 0}}
+            try:
+                print("%-18s ok    %s" % (scenario.__name__, scenario(fake, secrets)))
+            except AssertionError as e:
+                failed += 1
+                print("%-18s FAIL  %s" % (scenario.__name__, e))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
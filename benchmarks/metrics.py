@@ -0,0 +1,39 @@
+"""
+Micro-benchmark of the metrics module: cost of a span, enabled and switched off.
+
+Usage:
+    python benchmarks/metrics.py [spans]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import metrics  # noqa: E402
+
+
+def empty():
+    pass
+
+
+def spanned():
+    with metrics.span('sdk', cloud='aws', call='describe_instances'):
+        pass
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    baseline = min(timeit.repeat(empty, number=n, repeat=3))
+    print("%-10s %12s" % ("metrics", "us/span"))
+    for enabled in (True, False):
+        metrics.configure(enabled=enabled)
+        elapsed = min(timeit.repeat(spanned, number=n, repeat=3))
+        print("%-10s %12.2f" % ("on" if enabled else "off", (elapsed - baseline) / n * 1e6))
+    metrics.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Micro-benchmark of cloudmaster command parsing.
+
+Parses every slash command text of a corpus (benchmarks/data/commands.txt by default), with the precompiled command
+registry and with the parsing cloudmaster did before it (baseline_parse, the code of handle() and the command
+handlers up to the point they call a cloud, copied from the previous version).  Reports the mean time per command
+text, separately for valid commands and for invalid ones (which get help and suggestions).  Both parsers expand name
+ranges and validate clouds and filters.
+
+Usage:
+    python benchmarks/parsing.py [corpus] [rounds]
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import cloudmaster  # noqa: E402
+import commands  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'commands.txt')
+
+
+def load(path):
+    with open(path) as f:
+        lines = [line.rstrip('\n') for line in f]
+    return [line for line in lines if line.strip() and not line.startswith('#')]
+
+
+def registry_parse(text):
+    try:
+        return cloudmaster.COMMANDS.parse(text)
+    except commands.ParseError as e:
+        return e
+
+
+# the previous parsing code, the posts to slack and the cloud calls are left out
+
+CLOUDS = ['aws', 'azure', 'gcp', 'vsphere']
+MAX_BATCH = 50
+NAME_RANGE = re.compile(r"^(?P<prefix>[^{}]*)\{(?P<start>\d+)\.\.(?P<end>\d+)\}(?P<suffix>[^{}]*)$")
+
+
+def i_dont_understand(payload):
+    return {
+        "attachments": [
+            {
+                "title": "I don't understand",
+                "text": "I didn't understand your command... try:\n"
+                        "• create <vm name> on <" + '|'.join(CLOUDS) + "|all>\n"
+                        "• list <" + '|'.join(CLOUDS) + "|all> [status=<status>] [name=<pattern>]\n"
+                        "• delete <vm name> on <" + '|'.join(CLOUDS) + "|all>\n"
+                        "<vm name> can be a comma separated list or a range like web-{1..5}, "
+                        "up to " + str(MAX_BATCH) + " VMs\n",
+                "mrkdwn_in": [
+                    "text"
+                ],
+                "color": "danger"
+            }
+        ]
+    }
+
+
+def expand_names(text):
+    names = []
+    for part in text.split(','):
+        part = part.strip()
+        m = NAME_RANGE.match(part)
+        if m:
+            start, end = m.group('start'), m.group('end')
+            width = len(start) if start.startswith('0') else 0
+            if int(end) - int(start) >= MAX_BATCH:
+                return None
+            names.extend("%s%0*d%s" % (m.group('prefix'), width, i, m.group('suffix'))
+                         for i in range(int(start), int(end) + 1))
+        elif part:
+            names.append(part)
+
+    names = [n for i, n in enumerate(names) if n not in names[:i]]
+    if not names or len(names) > MAX_BATCH:
+        return None
+    return names
+
+
+def parse_filters(text):
+    filters = {}
+    for part in text.split():
+        key, sep, value = part.partition('=')
+        if not sep or not key or not value:
+            raise ValueError("invalid filter: %s" % part)
+        filters[key.lower()] = value.lower()
+    return filters
+
+
+def create(secrets, payload):
+    r = re.compile(r"^(?P<command>create)\s(?P<name>.+)\s(on)\s(?P<cloud>.+)\s*$")
+    m = r.match(payload["text"])
+    if not m:
+        return i_dont_understand(payload)
+
+    params = m.groupdict()
+    names = expand_names(params['name'])
+    cloud = params['cloud']
+    if not names or cloud not in ['all'] + CLOUDS:
+        return i_dont_understand(payload)
+    return names, cloud
+
+
+def list_instances(secrets, payload):
+    r = re.compile(r"^(?P<command>list)\s(?P<cloud>\S+)(?P<filters>.*)$")
+    m = r.match(payload["text"])
+    if not m:
+        return i_dont_understand(payload)
+
+    params = m.groupdict()
+    cloud = params['cloud']
+    try:
+        filters = parse_filters(params['filters'])
+    except ValueError:
+        return i_dont_understand(payload)
+
+    if cloud not in ['all'] + CLOUDS:
+        return i_dont_understand(payload)
+    return cloud, filters
+
+
+def delete(secrets, payload):
+    r = re.compile(r"^(?P<command>delete)\s(?P<name>.+)\s(on)\s(?P<cloud>.+)\s*$")
+    m = r.match(payload["text"])
+    if not m:
+        return i_dont_understand(payload)
+
+    params = m.groupdict()
+    names = expand_names(params['name'])
+    cloud = params['cloud']
+    if not names or cloud not in ['all'] + CLOUDS:
+        return i_dont_understand(payload)
+    return names, cloud
+
+
+def echo(secrets, payload):
+    return payload
+
+
+def baseline_parse(text):
+    payload = {"text": text}
+    command_name = payload["text"].split()[0]
+
+    handlers = {
+        "create": create,
+        "list": list_instances,
+        "delete": delete,
+        "echo": echo
+    }
+
+    command = handlers.get(command_name)
+    if command is None:
+        return i_dont_understand(payload)
+    return command({}, payload)
+
+
+def main():
+    corpus = load(sys.argv[1] if len(sys.argv) > 1 else CORPUS)
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    valid = [text for text in corpus if not isinstance(registry_parse(text), commands.ParseError)]
+    invalid = [text for text in corpus if text not in valid]
+
+    print("%d command texts (%d invalid), %d rounds" % (len(corpus), len(invalid), rounds))
+    print("%-10s %12s %12s" % ("parser", "valid us", "invalid us"))
+    for name, parse in (("registry", registry_parse), ("baseline", baseline_parse)):
+        times = []
+        for texts in (valid, invalid):
+            elapsed = timeit.timeit(lambda: [parse(text) for text in texts], number=rounds)
+            times.append(elapsed / rounds / max(len(texts), 1) * 1e6)
+        print("%-10s %12.2f %12.2f" % (name, times[0], times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Cold start benchmark of the functions.
+
+Imports every function module in a fresh interpreter with `python -X importtime` and reports the cumulative import
+time of the module (the median of a few runs) and the wall time (on top of starting the interpreter) of a first
+invocation failing validation, which should not load any cloud SDK.  Import times are checked against the
+"startup-<module>" entries of benchmarks/thresholds.json.
+
+Usage:
+    python benchmarks/startup.py [--write-thresholds]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions')
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+MODULES = ['cloudmaster', 'aws', 'gcp', 'azurecloud', 'vsphere', 'vsphereevents', 'status']
+
+RUNS = 5
+
+# a first invocation with an invalid payload
+INVALID = "import {0}; {0}.handle({{'secrets': {{}}}}, {{'command': 'nope', 'text': ''}})"
+
+
+def import_time(module):
+    """Returns the cumulative import time of module in seconds, None if it can't be imported"""
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], cwd=FUNCTIONS,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return None
+    for line in proc.stderr.splitlines():
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    return None
+
+
+def invalid_time(module=None):
+    """Returns the wall time of a fresh interpreter importing module and handling an invalid payload (of a fresh
+    interpreter doing nothing without module)"""
+
+    start = time.time()
+    proc = subprocess.run([sys.executable, '-c', INVALID.format(module) if module else 'pass'], cwd=FUNCTIONS,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.time() - start
+    return elapsed if proc.returncode == 0 else None
+
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) // 2] if values else None
+
+
+def main():
+    write = '--write-thresholds' in sys.argv[1:]
+    with open(THRESHOLDS) as f:
+        thresholds = json.load(f)
+
+    baseline = median([invalid_time() for _ in range(RUNS)])
+    failed = 0
+    print("%-14s %10s %12s  %s" % ("function", "import ms", "invalid ms", ""))
+    for module in MODULES:
+        imported = median([import_time(module) for _ in range(RUNS)])
+        if imported is None:
+            print("%-14s %10s %12s  can't be imported" % (module, '-', '-'))
+            continue
+        invalid = median([invalid_time(module) for _ in range(RUNS)])
+        key = 'startup-%s' % module
+        limit = thresholds.get(key, {}).get('import_ms')
+        status = 'ok'
+        if limit is not None and imported * 1000 > limit:
+            failed += 1
+            status = 'REGRESSION: import %.1fms > %.1fms' % (imported * 1000, limit)
+        print("%-14s %10.1f %12s  %s" % (module, imported * 1000,
+                                         '%.1f' % ((invalid - baseline) * 1000) if invalid is not None else '-',
+                                         status))
+        if write:
+            thresholds[key] = {'import_ms': round(max(imported * 1000 * 2, imported * 1000 + 50), 1)}
+
+    if write:
+        with open(THRESHOLDS, 'w') as f:
+            json.dump(thresholds, f, indent=2, sort_keys=True)
+            f.write('\n')
+    sys.exit(1 if failed and not write else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark of status notifications during a deployment wave.
+
+A burst of vm.being.deployed events is sent to the status function against a fake slack webhook limited to one post
+per second (like slack's).  Posting every event separately (the previous behavior, without retries) is compared with
+digests (see functions/poster.py).  Reports the posts made, the 429 responses and the events lost.  Also checks that
+messages spooled by a stopped process are posted by the next one.  Exits with a non-zero status if a digest loses
+an event.
+
+Usage:
+    python benchmarks/statusburst.py [events]
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import metrics  # noqa: E402
+import poster  # noqa: E402
+import status  # noqa: E402
+import transport  # noqa: E402
+from fakes import FakeDispatch  # noqa: E402
+
+EVENTS = 300
+# events of the direct mode, each rate limited one sleeps for a second
+DIRECT_EVENTS = 60
+CONCURRENCY = 20
+WINDOW = 0.5
+DRAIN_TIMEOUT = 120
+
+
+def message(i):
+    return "VM vm-%d is being deployed" % i
+
+
+def delivered(fake):
+    return "\n".join(m.get('text', '') for m in fake.messages)
+
+
+def lost(fake, events):
+    text = delivered(fake) + "\n"
+    return [i for i in range(events) if message(i) + "\n" not in text]
+
+
+def burst(func, events):
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        return list(executor.map(func, range(events)))
+
+
+def direct(events):
+    """Every event posted right away, failed posts are lost"""
+
+    transport.configure(retries=0)
+    try:
+        with FakeDispatch(slack_rate=1) as fake:
+            def post(i):
+                try:
+                    return transport.post(fake.slack_url, json={"text": message(i)}).ok
+                except Exception:
+                    return False
+
+            start = time.time()
+            burst(post, events)
+            return fake, time.time() - start
+    finally:
+        transport.reset()
+
+
+def digests(events, spool_dir):
+    """Events queued by the status function, posted as digests"""
+
+    with FakeDispatch(slack_rate=1) as fake:
+        secrets = {'statusUrl': fake.slack_url, 'statusDigest': {'window': WINDOW, 'spoolDir': spool_dir}}
+        start = time.time()
+        burst(lambda i: status.handle({'secrets': secrets}, {'message': message(i)}), events)
+        queued = poster.for_url(fake.slack_url)
+        deadline = time.time() + DRAIN_TIMEOUT
+        while queued.pending() and time.time() < deadline:
+            time.sleep(0.05)
+        return fake, time.time() - start
+
+
+def recovery(spool_dir):
+    """Messages spooled by a process stopped before posting them are posted by the next one"""
+
+    with FakeDispatch() as fake:
+        spool = poster.spool_path(spool_dir, fake.slack_url)
+        # the first process never gets to post (its window is longer than its life)
+        poster.Poster(fake.slack_url, window=3600, spool=spool).post(message(0))
+        restarted = poster.Poster(fake.slack_url, window=WINDOW, spool=spool)
+        deadline = time.time() + 10
+        while restarted.pending() and time.time() < deadline:
+            time.sleep(0.05)
+        return lost(fake, 1), os.path.getsize(spool)
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else EVENTS
+    metrics.configure(log=False)
+    spool_dir = tempfile.mkdtemp(prefix='statusburst-')
+    failed = False
+    try:
+        print("%-8s %8s %8s %8s %8s %10s" % ("mode", "events", "posts", "429s", "lost", "seconds"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            fake, elapsed = direct(DIRECT_EVENTS)
+        print("%-8s %8d %8d %8d %8d %10.1f" % ("direct", DIRECT_EVENTS, len(fake.messages), fake.rate_limited,
+                                               len(lost(fake, DIRECT_EVENTS)), elapsed))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            fake, elapsed = digests(events, spool_dir)
+        missing = lost(fake, events)
+        failed |= bool(missing)
+        print("%-8s %8d %8d %8d %8d %10.1f" % ("digest", events, len(fake.messages), fake.rate_limited,
+                                               len(missing), elapsed))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            missing, spool_size = recovery(spool_dir)
+        failed |= bool(missing) or spool_size != 0
+        print("spooled messages of a stopped process: %s" % ("lost" if missing else "posted after restart"))
+    finally:
+        shutil.rmtree(spool_dir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
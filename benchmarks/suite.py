@@ -0,0 +1,224 @@
+"""
+Offline benchmark suite.
+
+Drives the provider functions and cloudmaster through scenarios against fake clouds (see fakeclouds.py), a fake
+Dispatch and a fake slack (see fakes.py), so no cloud account is needed:
+
+* list-<cloud>-<n>: the provider's handle listing n VMs (10, 1000 and 10000 per cloud),
+* list-aws-regions, list-gcp-zones: listing 1000 VMs in each of 6 regions (zones),
+* teardown-gcp-100: deleting 100 GCP VMs and polling their operations once,
+* fanout-all: cloudmaster.handle running "list all", Dispatch runs call the provider handles in-process,
+* burst-100: 100 concurrent cloudmaster commands (list and create on all clouds).
+
+Reports p50/p99 latency and throughput of every scenario and checks them against benchmarks/thresholds.json.  Exits
+with a non-zero status if a scenario is slower than its threshold.
+
+Usage:
+    python benchmarks/suite.py [scenario prefix ...]
+    python benchmarks/suite.py --write-thresholds   # sets thresholds from the measured values
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import fakeclouds  # noqa: E402
+
+# latency of every fake API call, in seconds
+API_LATENCY = 0.002
+
+CLOUDS = {name: fakeclouds.FakeCloud(name, latency=API_LATENCY) for name in ('aws', 'azure', 'gcp', 'vsphere')}
+fakeclouds.install(CLOUDS)
+
+import aws  # noqa: E402
+import azurecloud  # noqa: E402
+import breaker  # noqa: E402
+import cloudmaster  # noqa: E402
+import gcp  # noqa: E402
+import metrics  # noqa: E402
+import sessionpool  # noqa: E402
+import vsphere  # noqa: E402
+import vsphereevents  # noqa: E402
+from fakes import FakeDispatch  # noqa: E402
+
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+VCENTER = fakeclouds.FakeVCenter(CLOUDS['vsphere'])
+vsphere.POOL = sessionpool.new_pool(VCENTER.connect, VCENTER.disconnect)
+
+SECRETS = {
+    'aws': {'access_key': 'key', 'secret_key': 'secret', 'region': 'us-west-2'},
+    'azure': {'clientId': 'id', 'password': 'secret', 'tenant': 'tenant', 'subscription': 'subscription',
+              'resource_group': 'cloudmaster', 'location': 'eastus2', 'subnet': 'default',
+              'virtual_network': 'cloudmaster', 'admin_password': 'secret'},
+    'gcp': {'type': 'service_account', 'project_id': 'cloudmaster', 'zone': 'us-west1-a'},
+    'vsphere': {'host': 'vcenter.local', 'username': 'administrator', 'password': 'secret'},
+}
+
+PROVIDERS = {
+    'aws': aws.handle,
+    'azure': azurecloud.handle,
+    'gcp': gcp.handle,
+    'vsphere': vsphere.handle,
+    'vsphere-inventory': vsphereevents.handle,
+}
+
+
+def percentile(values, q):
+    return breaker.percentile(values, q)
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def run_provider(function, payload, secrets=None):
+    cloud = 'vsphere' if function == 'vsphere-inventory' else function
+    return PROVIDERS[function]({'secrets': dict(SECRETS[cloud], **(secrets or {}))}, payload)
+
+
+def list_scenario(cloud, n, rounds, secrets=None, **payload):
+    def run():
+        CLOUDS[cloud].vms = n
+        return [timed(lambda: run_provider(cloud, dict(payload, command='list'), secrets))
+                for _ in range(rounds)], rounds
+    return run
+
+
+def teardown_scenario(n, rounds):
+    def run():
+        names = ['vm-%d' % i for i in range(n)]
+        secrets = SECRETS['gcp']
+
+        def teardown():
+            # deletes and a status poll of all deletions, as the tracker does it
+            result = run_provider('gcp', {'command': 'delete', 'names': names})
+            gcp.poll_operations(gcp.compute_client(secrets), None, secrets['project_id'], secrets['zone'],
+                                [r['operation'] for r in result])
+
+        return [timed(teardown) for _ in range(rounds)], rounds
+    return run
+
+
+def dispatch(fake, secrets):
+    """Makes the fake Dispatch run provider functions in-process"""
+
+    for function in PROVIDERS:
+        fake.outputs[function] = lambda data, function=function: run_provider(function, data['input'])
+    fake.outputs[cloudmaster.FUNCTION_NAME] = lambda data: cloudmaster.handle({'secrets': secrets}, data['input'])
+
+
+def fanout_scenario(rounds):
+    def run():
+        for cloud in CLOUDS.values():
+            cloud.vms = 1000
+        with FakeDispatch() as fake:
+            secrets = {'url': fake.url, 'defer': cloudmaster.DEFER_NONE, 'inventory': {'ttl': 0, 'maxStale': 0}}
+            dispatch(fake, secrets)
+            times = []
+            for i in range(rounds):
+                payload = {'text': 'list all', 'response_url': fake.slack_url, 'trigger_id': 'fanout-%d' % i}
+                times.append(timed(lambda: cloudmaster.handle({'secrets': secrets}, payload)))
+        return times, rounds
+    return run
+
+
+def burst_scenario(commands, concurrency):
+    def run():
+        for cloud in CLOUDS.values():
+            cloud.vms = 100
+        texts = ['create burst-%d on all' % i if i % 4 == 0 else 'list all' for i in range(commands)]
+        with FakeDispatch() as fake:
+            secrets = {'url': fake.url, 'defer': cloudmaster.DEFER_NONE, 'inventory': {'ttl': 1, 'maxStale': 10}}
+            dispatch(fake, secrets)
+
+            def command(i):
+                payload = {'text': texts[i], 'response_url': fake.slack_url, 'trigger_id': 'burst-%d' % i}
+                return timed(lambda: cloudmaster.handle({'secrets': secrets}, payload))
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                times = list(executor.map(command, range(commands)))
+        return times, commands
+    return run
+
+
+SCENARIOS = [('list-%s-%d' % (cloud, n), list_scenario(cloud, n, rounds))
+             for cloud in ('aws', 'azure', 'gcp', 'vsphere')
+             for n, rounds in ((10, 50), (1000, 20), (10000, 5))]
+SCENARIOS += [
+    ('list-aws-regions', list_scenario('aws', 1000, 10, regions=fakeclouds.REGIONS)),
+    ('list-gcp-zones', list_scenario('gcp', 1000, 10, zones='all')),
+    ('list-azure-subscription', list_scenario('azure', 1000, 20, secrets={'listScope': 'subscription'})),
+    ('teardown-gcp-100', teardown_scenario(100, 20)),
+    ('fanout-all', fanout_scenario(10)),
+    ('burst-100', burst_scenario(100, 20)),
+]
+
+
+def measure(run):
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        times, operations = run()
+    elapsed = time.time() - start
+    return {
+        'p50_ms': round(percentile(times, 50) * 1000, 1),
+        'p99_ms': round(percentile(times, 99) * 1000, 1),
+        'throughput': round(operations / elapsed, 1),
+    }
+
+
+def regressions(result, threshold):
+    failed = []
+    if 'p99_ms' in threshold and result['p99_ms'] > threshold['p99_ms']:
+        failed.append('p99 %.1fms > %.1fms' % (result['p99_ms'], threshold['p99_ms']))
+    if 'throughput' in threshold and result['throughput'] < threshold['throughput']:
+        failed.append('throughput %.1f/s < %.1f/s' % (result['throughput'], threshold['throughput']))
+    return failed
+
+
+def main():
+    args = sys.argv[1:]
+    write = '--write-thresholds' in args
+    prefixes = [a for a in args if not a.startswith('--')]
+
+    with open(THRESHOLDS) as f:
+        thresholds = json.load(f)
+
+    # no tracking threads piling up, no breaker tripping on purpose
+    metrics.configure(log=False)
+    breaker.configure(failures=1000)
+    for module in (aws, gcp, azurecloud, vsphere):
+        module.TRACKER.initial_delay = 60
+
+    failed = 0
+    print("%-22s %10s %10s %12s  %s" % ("scenario", "p50 ms", "p99 ms", "ops/s", ""))
+    for name, run in SCENARIOS:
+        if prefixes and not any(name.startswith(p) for p in prefixes):
+            continue
+        result = measure(run)
+        problems = regressions(result, thresholds.get(name, {}))
+        failed += bool(problems)
+        print("%-22s %10.1f %10.1f %12.1f  %s" % (name, result['p50_ms'], result['p99_ms'], result['throughput'],
+                                                  'REGRESSION: ' + ', '.join(problems) if problems else 'ok'))
+        if write:
+            # room for noisy machines: 3x the measured values, and at least 20ms more for short scenarios
+            thresholds[name] = {'p99_ms': round(max(result['p99_ms'] * 3, result['p99_ms'] + 20), 1),
+                                'throughput': round(result['throughput'] / 3, 1)}
+
+    if write:
+        with open(THRESHOLDS, 'w') as f:
+            json.dump(thresholds, f, indent=2, sort_keys=True)
+            f.write('\n')
+    sys.exit(1 if failed and not write else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Micro-benchmark of vSphere VM listing: SOAP round-trips vs number of VMs.
+
+The lazy listing reads summary and runtime of every VM, each read being a round-trip.  The bulk listing retrieves the
+same properties with RetrievePropertiesEx pages.  Round-trips are counted by fake objects, no vCenter is needed.
+
+Usage:
+    python benchmarks/vsphere_list.py
+"""
+
+import os
+import sys
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+from pyVmomi import vim  # noqa: E402
+
+import vsphereinventory  # noqa: E402
+
+Property = namedtuple('Property', ['name', 'val'])
+ObjectContent = namedtuple('ObjectContent', ['obj', 'propSet'])
+RetrieveResult = namedtuple('RetrieveResult', ['objects', 'token'])
+
+
+class Counter(object):
+    round_trips = 0
+
+
+class LazyVM(object):
+    """VM whose managed properties cost a round-trip per read, like pyVmomi stubs"""
+
+    def __init__(self, counter, i):
+        self._counter = counter
+        self._i = i
+
+    @property
+    def summary(self):
+        self._counter.round_trips += 1
+        config = namedtuple('Config', ['name', 'instanceUuid'])('vm-%d' % self._i, 'uuid-%d' % self._i)
+        return namedtuple('Summary', ['config'])(config)
+
+    @property
+    def runtime(self):
+        self._counter.round_trips += 1
+        return namedtuple('Runtime', ['powerState'])('poweredOn')
+
+
+class FakeCollector(object):
+    """PropertyCollector returning n VMs in pages of maxObjects"""
+
+    def __init__(self, counter, n):
+        self._counter = counter
+        self._objects = [
+            ObjectContent(vim.VirtualMachine('vm-%d' % i), [
+                Property('summary.config.name', 'vm-%d' % i),
+                Property('summary.config.instanceUuid', 'uuid-%d' % i),
+                Property('runtime.powerState', 'poweredOn'),
+            ]) for i in range(n)]
+        self._page_size = None
+
+    def _page(self, offset):
+        self._counter.round_trips += 1
+        end = offset + self._page_size
+        return RetrieveResult(self._objects[offset:end], str(end) if end < len(self._objects) else None)
+
+    def RetrievePropertiesEx(self, specs, options):
+        self._page_size = options.maxObjects
+        return self._page(0)
+
+    def ContinueRetrievePropertiesEx(self, token):
+        return self._page(int(token))
+
+    def CancelRetrievePropertiesEx(self, token):
+        self._counter.round_trips += 1
+
+
+def lazy_list(counter, n):
+    counter.round_trips += 1  # folder.childEntity
+    vms = [LazyVM(counter, i) for i in range(n)]
+    return [
+        {
+            'name': vm.summary.config.name,
+            'id': vm.summary.config.instanceUuid,
+            'status': vm.runtime.powerState,
+        }
+        for vm in vms]
+
+
+def bulk_list(counter, n):
+    content = namedtuple('Content', ['propertyCollector'])(FakeCollector(counter, n))
+    return vsphereinventory.list_vms(content, vim.Folder('group-v1'))
+
+
+def main():
+    print("%8s %12s %12s" % ("VMs", "lazy", "bulk"))
+    for n in (10, 100, 1000, 10000):
+        lazy, bulk = Counter(), Counter()
+        assert lazy_list(lazy, n) == bulk_list(bulk, n)
+        print("%8d %12d %12d" % (n, lazy.round_trips, bulk.round_trips))
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,10 @@ cat << EOF > aws.json
 }
 EOF
 
+VMs are created in "region".  To list the instances of more regions in parallel, add them to the secret (or the
+payload), e.g. "regions": ["us-west-2", "us-east-1"], or "regions": "all" for all regions enabled for the account.
+At most 8 regions are listed at the same time, "maxWorkers" in the secret changes that.
+
 Create a secret:
 
 dispatch create secret aws aws.json
@@ -38,61 +42,172 @@ dispatch create base-image python3-base dispatchframework/python3-base:0.0.13 --
 dispatch create image python-aws python3-base --runtime-deps requirements.txt
 
 Create a function:
-dispatch create function python-aws aws aws.py --secret aws
+dispatch create function python-aws aws . --handler aws.handle --secret aws
 
 Execute it:
 dispatch exec aws --wait --input='{"command": "create","name": "exampleVM"}'
 
 """
 
+import hashlib
+import itertools
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import clientcache
+import locations
+import metrics
+import operations
+import status
+
+TRACKER = operations.Tracker()
+
+COMMANDS = ('create', 'list', 'delete')
+
+# instance states listed, all but terminated
+LISTED_STATES = ('pending', 'running', 'shutting-down', 'stopping', 'stopped')
+
+# instances per describe_instances page, the maximum EC2 allows
+PAGE_SIZE = 1000
+
+# run_instances requests sent at the same time
+MAX_CONCURRENT_REQUESTS = 8
 
-import boto3
 
+def iter_instances(ec2_client, page_size=PAGE_SIZE):
+    """Yields id, name and status of instances managed by cloudmaster, pages are fetched lazily.
+    Terminated instances are filtered out by EC2, instances without a Name tag get an empty name"""
 
-def list_instances(ec2):
-    result = ec2.instances.filter(
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(
         Filters=[
             {
                 'Name': 'tag:managedby',
                 'Values': ['cloudmaster']
+            },
+            {
+                'Name': 'instance-state-name',
+                'Values': list(LISTED_STATES)
             }
-        ]
+        ],
+        PaginationConfig={'PageSize': page_size}
     )
+    pages = iter(pages)
+    while True:
+        with metrics.span('sdk', cloud='aws', call='describe_instances'):
+            page = next(pages, None)
+        if page is None:
+            return
+        for reservation in page['Reservations']:
+            for i in reservation['Instances']:
+                yield {
+                    "id": i['InstanceId'],
+                    "name": next((t['Value'] for t in i.get('Tags', ()) if t['Key'] == 'Name'), ''),
+                    "status": i['State']['Name'],
+                }
+
+
+def list_instances(ec2_client, limit=None):
+    """Returns a list of instances managed by cloudmaster, stops fetching pages once limit is reached"""
+
+    return list(itertools.islice(iter_instances(ec2_client), limit))
+
+
+def all_regions(secrets):
+    """Returns the names of all regions enabled for the account, cached like clients"""
+
+    def fetch():
+        ec2_client = ec2_clients(secrets)[1]
+        with metrics.span('sdk', cloud='aws', call='describe_regions'):
+            return [r['RegionName'] for r in ec2_client.describe_regions()['Regions']]
+
+    return clientcache.get("aws:regions", secrets, fetch)
+
+
+def list_regions(secrets, regions, limit=None):
+    """Lists instances of regions (or locations.ALL) in parallel, instances are tagged with their region as location.
+    Regions failing to list are logged and left out, unless all of them fail"""
+
+    if regions == locations.ALL:
+        regions = all_regions(secrets)
+    instances = locations.query(regions, lambda region: list_instances(ec2_clients(secrets, region)[1], limit),
+                                max_workers=secrets.get('maxWorkers', locations.MAX_WORKERS))
+    try:
+        return list(itertools.islice(instances, limit))
+    finally:
+        instances.close()
+
+
+def run_instance(ec2_client, name, client_token=None):
+    """Starts an instance named name, returns its id. EC2 runs a request with a client token only once, a repeated
+    request returns the same instance"""
+
+    kwargs = {'ClientToken': client_token} if client_token else {}
+    with metrics.span('sdk', cloud='aws', call='run_instances'):
+        result = ec2_client.run_instances(
+            MinCount=1, MaxCount=1, ImageId="ami-0f47ef92b4218ec09",
+            InstanceType="t1.micro",
+            TagSpecifications=[
+                {
+                    'ResourceType': 'instance',
+                    # tagged when it is created, a later create_tags may not find the instance yet
+                    'Tags': [
+                        {
+                            'Key': 'managedby',
+                            'Value': 'cloudmaster'
+                        },
+                        {
+                            'Key': 'Name',
+                            'Value': name
+                        }
+                    ]
+                }
+            ], **kwargs)
+    return result['Instances'][0]['InstanceId']
+
+
+def instance_token(client_token, name):
+    """Returns the client token of the instance name of a request, at most 64 characters like EC2 requires"""
+
+    return hashlib.sha256(("%s:%s" % (client_token, name)).encode('utf-8')).hexdigest()[:64]
+
+
+def create_instances(ec2_client, names, client_token=None):
+    """Creates one instance per name, with a request per name sent concurrently.  Returns a result per name: the
+    instance and the operation of all created instances, or an error.  Instances of a request's client token are only
+    created once"""
+
+    def start(name):
+        try:
+            return run_instance(ec2_client, name, instance_token(client_token, name) if client_token else None), None
+        except Exception as e:
+            print("creating {} failed: {}".format(name, e))
+            return None, str(e)
+
+    with ThreadPoolExecutor(max_workers=min(len(names), MAX_CONCURRENT_REQUESTS)) as executor:
+        started = list(executor.map(metrics.propagate(start), names))
+
+    created = [(name, instance_id) for name, (instance_id, _) in zip(names, started) if instance_id]
+    op = operations.operation('aws', 'create', ', '.join(name for name, _ in created),
+                              [instance_id for _, instance_id in created])
     return [{
-            "id": i.id,
-            "name": [t["Value"] for t in i.tags if t["Key"] == "Name"][0],
-            "status": i.state["Name"],
-            } for i in result if i.state["Name"] != "terminated"]
+        "id": instance_id,
+        "name": name,
+        "operation": op,
+    } if instance_id else {
+        "name": name,
+        "error": error,
+    } for name, (instance_id, error) in zip(names, started)]
 
 
-def create_instance(ec2, name):
-    result = ec2.create_instances(
-        MinCount=1, MaxCount=1, ImageId="ami-0f47ef92b4218ec09",
-        InstanceType="t1.micro",
-        TagSpecifications=[
-            {
-                'ResourceType': 'instance',
-                'Tags': [
-                    {
-                        'Key': 'managedby',
-                        'Value': 'cloudmaster'
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': name
-                    }
-                ]
-            }
-        ])
-    instance = result[0]
-    return {
-        "id": instance.id,
-        "name": name,
-    }
+def create_instance(ec2_client, name, client_token=None):
+    return create_instances(ec2_client, [name], client_token)[0]
 
 
-def delete_instance(ec2_resource, ec2_client, name):
+def delete_instances(ec2_resource, ec2_client, names):
+    """Terminates instances of all names with a single request"""
+
     instances = ec2_resource.instances.filter(
         Filters=[
             {
@@ -101,40 +216,114 @@ def delete_instance(ec2_resource, ec2_client, name):
             },
             {
                 'Name': "tag:Name",
-                'Values': [name]
+                'Values': names
             }
         ]
     )
-    instanceIds = [i.id for i in instances]
+    with metrics.span('sdk', cloud='aws', call='describe_instances'):
+        instanceIds = [i.id for i in instances]
     print(instanceIds)
-    return ec2_client.terminate_instances(InstanceIds=instanceIds)
+    with metrics.span('sdk', cloud='aws', call='terminate_instances'):
+        result = ec2_client.terminate_instances(InstanceIds=instanceIds)
+    result['operation'] = operations.operation('aws', 'delete', ', '.join(names), instanceIds)
+    return result
 
 
+def delete_instance(ec2_resource, ec2_client, name):
+    return delete_instances(ec2_resource, ec2_client, [name])
+
+
+def poll_instances(ec2_client, op):
+    """Polls instances of a create or delete operation, returns (done, error).  EC2 is eventually consistent, instances
+    just created may not be described yet (or make describe_instances raise InvalidInstanceID.NotFound, which the
+    tracker retries), they are not done yet"""
+
+    with metrics.span('sdk', cloud='aws', call='describe_instances'):
+        resp = ec2_client.describe_instances(InstanceIds=op['ref'])
+    states = [i['State']['Name'] for r in resp['Reservations'] for i in r['Instances']]
+    if len(states) < len(op['ref']):
+        return False, None
+    if op['kind'] == 'create':
+        if any(s in ('shutting-down', 'terminated') for s in states):
+            return True, "instance terminated while starting"
+        return all(s == 'running' for s in states), None
+    return all(s == 'terminated' for s in states), None
+
+
+class RegionalClients(object):
+    """EC2 resources and clients of an account by region, built on first use"""
+
+    def __init__(self, secrets):
+        self._secrets = secrets
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _build(self, region):
+        # imported on first use, commands failing validation don't pay for loading boto3
+        import boto3.session
+        session = boto3.session.Session(aws_access_key_id=self._secrets['access_key'],
+                                        aws_secret_access_key=self._secrets['secret_key'],
+                                        region_name=region)
+        ec2_resource = session.resource("ec2")
+        # the resource's client shares its connection pool and credentials
+        return ec2_resource, ec2_resource.meta.client
+
+    def get(self, region):
+        with self._lock:
+            clients = self._clients.get(region)
+        if clients is None:
+            clients = self._build(region)
+            with self._lock:
+                clients = self._clients.setdefault(region, clients)
+        return clients
+
+
+def ec2_clients(secrets, region=None):
+    """Returns EC2 resource and client of a region (the secret's region by default). Both are cached between
+    invocations of a warm function, the clients of all regions of an account are a single cache entry (listing all
+    regions would evict every other client otherwise)"""
+
+    regional = clientcache.get("aws:ec2", secrets, lambda: RegionalClients(secrets))
+    return regional.get(region or secrets['region'])
+
+
+@metrics.instrumented('aws')
 def handle(ctx, payload):
     """
     entry point for AWS commands
     """
 
-    access_key = ctx['secrets']['access_key']
-    secret_key = ctx['secrets']['secret_key']
-    region = ctx['secrets']['region']
-
-    ec2_resource = boto3.resource("ec2", aws_access_key_id=access_key,
-                                  aws_secret_access_key=secret_key, region_name=region)
-    ec2_client = boto3.client("ec2", aws_access_key_id=access_key,
-                              aws_secret_access_key=secret_key, region_name=region)
-
     if 'command' not in payload:
         return _error('command is required')
     command = payload['command']
+    if command not in COMMANDS:
+        return {"error": "command {} is not supported".format(command)}
+    if command in ('create', 'delete') and 'name' not in payload and 'names' not in payload:
+        return _error('vm name is required')
 
-    result = {"error": "command {} is not supported".format(command)}
-    if command == 'create':
-        result = create_instance(ec2_resource, payload['name'])
     if command == 'list':
-        result = list_instances(ec2_resource)
+        regions = locations.requested(payload, ctx['secrets'], 'regions', ctx['secrets']['region'])
+        if regions != locations.ALL and len(regions) == 1:
+            return list_instances(ec2_clients(ctx['secrets'], regions[0])[1], payload.get('limit'))
+        return list_regions(ctx['secrets'], regions, payload.get('limit'))
+
+    ec2_resource, ec2_client = ec2_clients(ctx['secrets'])
+
+    if command == 'create':
+        if 'names' in payload:
+            result = create_instances(ec2_client, payload['names'], payload.get('requestId'))
+        else:
+            result = create_instance(ec2_client, payload['name'], payload.get('requestId'))
     if command == 'delete':
-        result = delete_instance(ec2_resource, ec2_client, payload['name'])
+        names = payload.get('names') or [payload['name']]
+        result = delete_instances(ec2_resource, ec2_client, names)
+
+    if command in ('create', 'delete'):
+        op = next((r['operation'] for r in (result if isinstance(result, list) else [result]) if 'operation' in r),
+                  None)
+        # nothing to poll if no instance was started (describe_instances without ids describes all of them)
+        if op is not None and op['ref']:
+            TRACKER.track(op, lambda: poll_instances(ec2_client, op), status.notifier(ctx['secrets']))
 
     return result
 
@@ -24,6 +24,7 @@ cat << EOF > azure.json
     "password": "<UUID>",
     "tenant": "<UUID>",
     "subscription": "<UUID>",
+    "resource_group": "<name of the resource group VMs are created and listed in>",
     "admin_password": "<Password for admin account within a VM>",
     "location": "<Azure region, e.g. eastus2>",
     "subnet": "<name of the subnet to connect VM to>",
@@ -31,6 +32,9 @@ cat << EOF > azure.json
 }
 EOF
 
+list only looks at the resource group. To list VMs managed by cloudmaster in the whole subscription (using a tag
+filtered resource query), add "listScope": "subscription".
+
 Create a secret:
 
 dispatch create secret azure azure.json
@@ -47,26 +51,39 @@ dispatch create base-image python3-base dispatchframework/python3-base:0.0.13 --
 dispatch create image python-azure python3-base --runtime-deps requirements.txt
 
 Create a function:
-dispatch create function python-azure azure azurecloud.py --secret azure
+dispatch create function python-azure azure . --handler azurecloud.handle --secret azure
 
 Execute it:
 dispatch exec azure --wait --input='{"command": "create","name": "exampleVM"}'
 
+Several VMs can be created (or deleted) at once:
+dispatch exec azure --wait --input='{"command": "create","names": ["exampleVM1", "exampleVM2"]}'
+
 """
 
+import functools
+import itertools
 import json
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import clientcache
+import metrics
+import operations
+import status
 
-from azure.common.credentials import ServicePrincipalCredentials
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.compute import ComputeManagementClient
+TRACKER = operations.Tracker()
 
-from msrestazure.azure_exceptions import CloudError
+SUBNET_TTL = 60 * 60
+MAX_CONCURRENT_REQUESTS = 8
+
+COMMANDS = ('create', 'list', 'delete')
 
 
 def get_credentials(client_id, secret, tenant):
     """Creates Azure credentials object from string credentials"""
 
+    from azure.common.credentials import ServicePrincipalCredentials
     credentials = ServicePrincipalCredentials(
         client_id=client_id,
         secret=secret,
@@ -75,23 +92,89 @@ def get_credentials(client_id, secret, tenant):
     return credentials
 
 
-def list_instances(compute_client):
-    """Returns a list of instances managed by cloudmaster"""
+def management_clients(secrets):
+    """Returns compute and network management clients. Both clients and the credentials (with their token) are
+    cached between invocations of a warm function"""
+
+    def build():
+        # imported on first use, commands failing validation don't pay for loading the SDK
+        from azure.mgmt.compute import ComputeManagementClient
+        from azure.mgmt.network import NetworkManagementClient
+        credentials = get_credentials(client_id=secrets['clientId'],
+                                      secret=secrets['password'],
+                                      tenant=secrets['tenant'])
+        return (ComputeManagementClient(credentials, secrets['subscription']),
+                NetworkManagementClient(credentials, secrets['subscription']))
+
+    return clientcache.get("azure:management", secrets, build)
+
+
+def resource_client(secrets):
+    """Returns resource management client, cached between invocations of a warm function"""
+
+    def build():
+        from azure.mgmt.resource import ResourceManagementClient
+        credentials = get_credentials(client_id=secrets['clientId'],
+                                      secret=secrets['password'],
+                                      tenant=secrets['tenant'])
+        return ResourceManagementClient(credentials, secrets['subscription'])
+
+    return clientcache.get("azure:resource", secrets, build)
+
+
+def _managed(tags):
+    return bool(tags) and tags.get('managedby') == 'cloudmaster'
+
+
+def iter_group_instances(compute_client, resource_group):
+    """Yields instances managed by cloudmaster in a resource group. Pages are fetched lazily"""
+
+    for vm in compute_client.virtual_machines.list(resource_group):
+        if _managed(vm.tags):
+            yield {
+                "id": vm.id,
+                "name": vm.name,
+                "status": vm.provisioning_state,
+                "tags": vm.tags
+            }
+
+
+def iter_tagged_instances(resource_client):
+    """Yields instances managed by cloudmaster in the whole subscription. Only resources tagged managedby=cloudmaster
+    are returned by the API, pages are fetched lazily"""
 
-    return [{
-            "id": vm.id,
-            "name": vm.name,
-            "status": vm.provisioning_state,
-            "tags": vm.tags
-            } for vm in compute_client.virtual_machines.list_all()
-            if vm.tags and 'managedby' in vm.tags and vm.tags['managedby'] == 'cloudmaster']
+    resources = resource_client.resources.list(filter="tagName eq 'managedby' and tagValue eq 'cloudmaster'",
+                                                expand="provisioningState")
+    for r in resources:
+        if r.type == 'Microsoft.Compute/virtualMachines':
+            yield {
+                "id": r.id,
+                "name": r.name,
+                # GenericResource of the pinned azure-mgmt-resource (2.0.0) has no provisioning_state, newer ones
+                # fill it in with the expand
+                "status": getattr(r, 'provisioning_state', None),
+                "tags": r.tags
+            }
 
 
-def create_nic(network_client, location, resource_group, virtual_network, subnet, vm_name):
-    """Creates a network interface required by a VM"""
+def list_instances(instances, limit=None):
+    """Returns a list of instances managed by cloudmaster, stops fetching pages once limit is reached"""
 
-    subnet = network_client.subnets.get(resource_group, virtual_network, subnet)
-    async_nic_creation = network_client.network_interfaces.create_or_update(
+    return list(itertools.islice(instances, limit))
+
+
+def get_subnet(network_client, secrets, resource_group, virtual_network, subnet):
+    """Returns the subnet VMs are connected to, cached per (virtual network, subnet)"""
+
+    return clientcache.get("azure:subnet:{}/{}/{}".format(resource_group, virtual_network, subnet), secrets,
+                           lambda: network_client.subnets.get(resource_group, virtual_network, subnet),
+                           ttl=SUBNET_TTL)
+
+
+def create_nic(network_client, location, resource_group, subnet, vm_name):
+    """Starts creation of a network interface required by a VM, returns the operation poller"""
+
+    return network_client.network_interfaces.create_or_update(
         resource_group,
         "{}-nic".format(vm_name),
         {
@@ -104,64 +187,142 @@ def create_nic(network_client, location, resource_group, virtual_network, subnet
             }]
         }
     )
-    return async_nic_creation.result(timeout=1)
 
 
 def delete_nic(network_client, resource_group, name):
-    """Delete network interface"""
-    network_client.network_interfaces.delete(resource_group, "{}-nic".format(name))
+    """Starts deletion of a network interface, returns the operation poller"""
+    return network_client.network_interfaces.delete(resource_group, "{}-nic".format(name))
 
 
 def create_instance(compute_client, location, resource_group, nic, name, admin_password):
-    """Creates an Azure VM. expects Network interface to be pre-created."""
-    try:
-        vm_parameters = {
-            'location': location,
-            'hardware_profile': {
-                'vm_size': 'Standard_DS1_v2'
-            },
-            'tags': {
-                'managedby': 'cloudmaster'
+    """Starts creation of an Azure VM. expects Network interface to be pre-created. Returns the operation poller"""
+    vm_parameters = {
+        'location': location,
+        'hardware_profile': {
+            'vm_size': 'Standard_DS1_v2'
+        },
+        'tags': {
+            'managedby': 'cloudmaster'
+        },
+        'os_profile': {
+            'computer_name': name,
+            'admin_username': 'dispatch',
+            'admin_password': admin_password
+        },
+        'storage_profile': {
+            'image_reference': {
+                'publisher': 'Canonical',
+                'offer': 'UbuntuServer',
+                'sku': '16.04.0-LTS',
+                'version': 'latest'
             },
-            'os_profile': {
-                'computer_name': name,
-                'admin_username': 'dispatch',
-                'admin_password': admin_password
-            },
-            'storage_profile': {
-                'image_reference': {
-                    'publisher': 'Canonical',
-                    'offer': 'UbuntuServer',
-                    'sku': '16.04.0-LTS',
-                    'version': 'latest'
-                },
-            },
-            'network_profile': {
-                'network_interfaces': [{
-                    'id': nic.id,
-                }]
-            },
-        }
-        async_vm_creation = compute_client.virtual_machines.create_or_update(
-            resource_group, name, vm_parameters)
-        vm = async_vm_creation.result(timeout=1)
-        return {
-            "id": vm.id,
-            "name": vm.name,
-            "state": vm.provisioning_state,
-            "tags": vm.tags
-        }
-    except CloudError:
-        return _error(traceback.format_exc())
+        },
+        'network_profile': {
+            'network_interfaces': [{
+                'id': nic.id,
+            }]
+        },
+    }
+    return compute_client.virtual_machines.create_or_update(resource_group, name, vm_parameters)
 
 
 def delete_instance(compute_client, resource_group, name):
-    """Delete an instance"""
+    """Starts deletion of an instance, returns the operation poller"""
+    return compute_client.virtual_machines.delete(resource_group, name)
+
+
+class Chain(object):
+    """Poller-like operation which starts next(result) once first is done, then follows the poller it returned.
+
+    Nothing waits on the pollers: the next step is started by advance() (or done()) once the first poller is done,
+    when the tracker polls the operation.  A chain is polled by a single thread at a time, it is not thread safe.
+    """
+
+    def __init__(self, first, next):
+        self._poller = first
+        self._next = next
+        self._exception = None
+
+    def ready(self):
+        """True if the next step can be started"""
+
+        return self._next is not None and self._poller.done()
+
+    def advance(self):
+        """Starts the next step, the first poller must be done"""
+
+        next_step, self._next = self._next, None
+        try:
+            # the poller is done, result() returns (or raises) right away
+            self._poller = next_step(self._poller.result())
+        except Exception as e:
+            self._exception = e
+
+    def done(self):
+        if self.ready():
+            self.advance()
+        if self._exception is not None:
+            return True
+        return self._next is None and self._poller.done()
+
+    def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._poller.result(timeout)
+
+
+def provision(compute_client, network_client, secrets, names):
+    """Starts creation of VMs, returns {name: poller-like operation}.
+
+    The subnet is looked up once (and cached), the NIC creations of all VMs are started concurrently and each VM is
+    created as soon as its NIC is ready.
+    """
+
+    subnet = get_subnet(network_client, secrets, secrets['resource_group'],
+                        secrets['virtual_network'], secrets['subnet'])
+
+    def start(name):
+        nic = create_nic(network_client, secrets['location'], secrets['resource_group'], subnet, name)
+        return Chain(nic, lambda n: create_instance(compute_client, secrets['location'], secrets['resource_group'],
+                                                    n, name, secrets['admin_password']))
+
+    with ThreadPoolExecutor(max_workers=min(len(names), MAX_CONCURRENT_REQUESTS)) as executor:
+        return dict(zip(names, executor.map(start, names)))
+
+
+def deprovision(compute_client, network_client, resource_group, names):
+    """Starts deletion of VMs, returns {name: poller-like operation}. NICs are deleted once their VM is gone"""
+
+    def start(name):
+        vm = delete_instance(compute_client, resource_group, name)
+        return Chain(vm, lambda _: delete_nic(network_client, resource_group, name))
+
+    with ThreadPoolExecutor(max_workers=min(len(names), MAX_CONCURRENT_REQUESTS)) as executor:
+        return dict(zip(names, executor.map(start, names)))
+
+
+def poll_operation(poller):
+    """Polls an Azure operation poller, returns (done, error)"""
+
+    if not poller.done():
+        return False, None
     try:
-        async_vm_deletion = compute_client.virtual_machines.delete(resource_group, name)
-        return async_vm_deletion.result(timeout=1)
-    except CloudError:
-        return _error(traceback.format_exc())
+        poller.result(0)
+    except Exception as e:
+        return True, str(e)
+    return True, None
+
+
+def poll_operations(pollers, ops):
+    """Polls the operations of ops, pollers are keyed by VM name. Returns (done, error) per operation.
+    The next steps of chains which are ready are started concurrently first"""
+
+    pollers = [pollers[op['name']] for op in ops]
+    ready = [p for p in pollers if isinstance(p, Chain) and p.ready()]
+    if ready:
+        with ThreadPoolExecutor(max_workers=min(len(ready), MAX_CONCURRENT_REQUESTS)) as executor:
+            list(executor.map(Chain.advance, ready))
+    return [poll_operation(p) for p in pollers]
 
 
 def _error(error_msg):
@@ -170,44 +331,64 @@ def _error(error_msg):
     })
 
 
+@metrics.instrumented('azure')
 def handle(ctx, payload):
     """entrypoint for Azure operations """
-    resource_group = ctx['secrets']['resource_group']
-    location = ctx['secrets']['location']
-    subscription = ctx['secrets']['subscription']
-    admin_password = ctx['secrets']['admin_password']
-    subnet = ctx['secrets']['subnet']
-    virtual_network = ctx['secrets']['virtual_network']
-
-    credentials = get_credentials(client_id=ctx['secrets']['clientId'],
-                                  secret=ctx['secrets']['password'],
-                                  tenant=ctx['secrets']['tenant'])
-
-    compute_client = ComputeManagementClient(credentials, subscription)
-    network_client = NetworkManagementClient(credentials, subscription)
-
     if 'command' not in payload:
         return _error('command is required')
     command = payload['command']
+    if command not in COMMANDS:
+        return {"error": "command {} is not supported".format(command)}
+    # several VMs can be handled at once with "names"
+    if command in ('create', 'delete') and 'name' not in payload and 'names' not in payload:
+        return _error('vm name is required')
 
-    # default result is unsupported command
-    result = {"error": "command {} is not supported".format(command)}
-
-    if command == 'create':
-
-        if 'name' not in payload:
-            return _error('vm name is required')
-        vm_name = payload['name']
+    resource_group = ctx['secrets']['resource_group']
 
-        nic = create_nic(network_client, location,resource_group, virtual_network, subnet, vm_name)
-        result = create_instance(compute_client, location, resource_group, nic, vm_name, admin_password)
+    if command in ('create', 'delete'):
+        from msrestazure.azure_exceptions import CloudError
+
+        compute_client, network_client = management_clients(ctx['secrets'])
+        names = payload.get('names') or [payload['name']]
+
+        try:
+            with metrics.span('sdk', cloud='azure', call=command):
+                if command == 'create':
+                    pollers = provision(compute_client, network_client, ctx['secrets'], names)
+                else:
+                    pollers = deprovision(compute_client, network_client, resource_group, names)
+        except CloudError:
+            return _error(traceback.format_exc())
+
+        results, ops = [], []
+        for name in names:
+            op = operations.operation('azure', command, name)
+            ops.append(op)
+            if command == 'create':
+                results.append({
+                    "name": name,
+                    "state": "Creating",
+                    "tags": {'managedby': 'cloudmaster'},
+                    "operation": op,
+                })
+            else:
+                results.append({
+                    "status": "vm deletion started",
+                    "operation": op,
+                })
+        # the VMs are polled (and their chained steps started) together, by a single thread
+        TRACKER.track_all(ops, functools.partial(poll_operations, pollers), status.notifier(ctx['secrets']))
+        result = results if 'names' in payload else results[0]
 
     if command == 'list':
-        result = list_instances(compute_client)
-
-    if command == 'delete':
-        result = delete_instance(compute_client, resource_group, payload['name'])
-        delete_nic(network_client, resource_group, payload['name'])
+        # instances are looked up in the resource group, unless listScope is "subscription"
+        if ctx['secrets'].get('listScope') == 'subscription':
+            instances = iter_tagged_instances(resource_client(ctx['secrets']))
+        else:
+            instances = iter_group_instances(management_clients(ctx['secrets'])[0], resource_group)
+        # the instances are fetched page by page while they are listed
+        with metrics.span('sdk', cloud='azure', call='list'):
+            result = list_instances(instances, payload.get('limit'))
 
     return result
 
@@ -0,0 +1,172 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Circuit breakers and adaptive timeouts for calls to cloud functions.
+
+A breaker is closed while calls succeed.  After `failures` consecutive failures (errors or timeouts) it opens and
+calls fail right away, without waiting for the cloud.  After `resetTimeout` seconds it is half-open: a single probe
+call is let through, its success closes the breaker, its failure opens it again.
+
+Breakers also keep the latencies of the last `window` successful calls per operation.  Once there are enough of them,
+the timeout of a call is the p99 latency times `timeoutFactor`, but at least `minTimeout` seconds and at most the
+configured timeout.
+
+Breakers live in module globals, so their state survives warm invocations.  Settings can be changed with configure(),
+e.g. from the "breaker" entry of the cloudmaster secret:
+
+{
+  "breaker": {
+    "failures": 3,
+    "resetTimeout": 60,
+    "timeoutFactor": 2
+  }
+}
+"""
+
+import threading
+import time
+from collections import deque
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+DEFAULTS = {
+    "failures": 5,
+    "resetTimeout": 30.0,
+    "window": 100,
+    "minSamples": 20,
+    "timeoutFactor": 3.0,
+    "minTimeout": 5.0,
+}
+
+
+class BreakerOpen(Exception):
+    """Raised for calls to a cloud whose breaker is open"""
+
+    def __init__(self, name, retry_in):
+        super(BreakerOpen, self).__init__(
+            "{} is degraded, not trying it for another {:.0f}s".format(name, max(retry_in, 1)))
+        self.name = name
+        self.retry_in = retry_in
+
+
+def percentile(values, q):
+    """Returns the q-th percentile (0-100) of values, nearest rank"""
+
+    ordered = sorted(values)
+    rank = max(int(round(q / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Breaker(object):
+    """Circuit breaker of a single cloud"""
+
+    def __init__(self, name, settings=None, clock=time.time):
+        self.name = name
+        self.settings = dict(DEFAULTS, **(settings or {}))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if self._clock() - self._opened_at >= self.settings["resetTimeout"]:
+            return HALF_OPEN
+        return OPEN
+
+    def check(self):
+        """Raises BreakerOpen if calls should not be made now. In half-open state a single call is let through"""
+
+        with self._lock:
+            state = self._state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            retry_in = self._opened_at + self.settings["resetTimeout"] - self._clock()
+        raise BreakerOpen(self.name, retry_in)
+
+    def success(self, operation, latency):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+            latencies = self._latencies.get(operation)
+            if latencies is None or latencies.maxlen != self.settings["window"]:
+                latencies = self._latencies[operation] = deque(latencies or (), maxlen=self.settings["window"])
+            latencies.append(latency)
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.settings["failures"]:
+                self._opened_at = self._clock()
+            self._probing = False
+
+    def percentile(self, operation, q):
+        """Returns the q-th percentile of recent latencies of an operation, None without enough samples"""
+
+        with self._lock:
+            latencies = list(self._latencies.get(operation, ()))
+        if len(latencies) < self.settings["minSamples"]:
+            return None
+        return percentile(latencies, q)
+
+    def timeout(self, operation, limit):
+        """Returns the timeout for a call: derived from the p99 latency, at most limit"""
+
+        p99 = self.percentile(operation, 99)
+        if p99 is None:
+            return limit
+        return min(limit, max(self.settings["minTimeout"], p99 * self.settings["timeoutFactor"]))
+
+
+_settings = dict(DEFAULTS)
+_breakers = {}
+_lock = threading.Lock()
+
+
+def configure(**settings):
+    """Updates breaker settings of all clouds, breakers keep their state"""
+
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("unknown breaker settings: %s" % ', '.join(sorted(unknown)))
+
+    with _lock:
+        _settings.update(settings)
+        for b in _breakers.values():
+            b.settings.update(settings)
+
+
+def reset():
+    """Restores default settings and forgets the state of all breakers"""
+
+    with _lock:
+        _settings.clear()
+        _settings.update(DEFAULTS)
+        _breakers.clear()
+
+
+def get(name):
+    """Returns the breaker of a cloud"""
+
+    with _lock:
+        b = _breakers.get(name)
+        if b is None:
+            b = _breakers[name] = Breaker(name, _settings)
+        return b
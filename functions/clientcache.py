@@ -0,0 +1,96 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Process-level cache for authenticated cloud SDK clients.
+
+Building SDK clients (and fetching the OAuth tokens and discovery documents behind them) is the most expensive part
+of short commands such as list.  Function containers are reused between invocations, so clients are kept in this
+module and reused as long as:
+
+* they are younger than their TTL,
+* the secret they were built from did not change (entries remember a hash of the secret, a rotated secret rebuilds
+  the client).
+
+The cache is bounded, least recently used entries are evicted first.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 30 * 60
+MAX_ENTRIES = 16
+
+
+def secret_hash(secret):
+    """Returns a stable hash of a secret (dict or string)"""
+
+    if not isinstance(secret, str):
+        secret = json.dumps(secret, sort_keys=True)
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+class ClientCache(object):
+    """LRU cache of clients keyed by name, invalidated by TTL and secret changes"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, secret, factory, ttl=None):
+        """Returns the cached client for name, calling factory() to build it when missing, expired or rotated"""
+
+        digest = secret_hash(secret)
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry_digest, client, expires = entry
+                if entry_digest == digest and now < expires:
+                    self._entries.move_to_end(name)
+                    return client
+                del self._entries[name]
+
+        client = factory()
+
+        with self._lock:
+            self._entries[name] = (digest, client, now + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return client
+
+    def invalidate(self, name=None):
+        """Drops the entry for name, or all entries if name is None"""
+
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_default = ClientCache()
+
+
+def get(name, secret, factory, ttl=None):
+    """Returns a client from the process-wide cache"""
+
+    return _default.get(name, secret, factory, ttl)
+
+
+def invalidate(name=None):
+    """Invalidates entries of the process-wide cache"""
+
+    _default.invalidate(name)
@@ -1,21 +1,65 @@
+import functools
 import json
 import re
-import requests
+import threading
+import time
+from collections import OrderedDict
+
+import breaker
+import commands
+import fanout
+import idempotency
+import inventorycache
+import metrics
+import render
+import transport
 
 CLOUDS = ['aws', 'azure', 'gcp', 'vsphere']
 
+# functions answering list instead of the cloud's own function. vsphere-inventory keeps an inventory up to date with
+# vcenter events, so listing does not poll vCenter
+LIST_FUNCTIONS = {
+    'vsphere': 'vsphere-inventory',
+}
 
-def i_dont_understand(payload):
-    """Prints help message when user provides unsupported command"""
+# maximum number of VMs created or deleted by a single command
+MAX_BATCH = 50
 
+# failed VMs listed (with their errors) in the reply to a create or delete
+MAX_LISTED_FAILURES = 10
+
+# how commands are run after the slash command was acknowledged, see defer()
+DEFER_DISPATCH = 'dispatch'
+DEFER_THREAD = 'thread'
+DEFER_NONE = 'none'
+
+# the function deferred commands are run by, and how long to wait for Dispatch to accept the run
+FUNCTION_NAME = 'cloudmaster'
+# (connect, read) timeouts and retries of the non-blocking run started by defer(), at most 2 connection attempts of
+# DEFER_TIMEOUT[0] and a read of DEFER_TIMEOUT[1] seconds keep the acknowledgement within slack's 3 seconds
+DEFER_TIMEOUT = (0.5, 1.0)
+DEFER_RETRIES = 1
+
+# retried slash commands are answered from here, retries of a running command wait up to DUPLICATE_WAIT seconds
+REQUESTS = idempotency.Store()
+DUPLICATE_WAIT = 2
+
+NAME_RANGE = re.compile(r"^(?P<prefix>[^{}]*)\{(?P<start>\d+)\.\.(?P<end>\d+)\}(?P<suffix>[^{}]*)$")
+
+
+def i_dont_understand(payload, error=None):
+    """Returns the help message for an unsupported command, it is sent back as the reply to the slash command"""
+
+    text = "I didn't understand your command"
+    if error is not None:
+        text += ": {}".format(error)
+        if error.suggestion:
+            text += ", did you mean `{}`?".format(error.suggestion)
     response = {
         "attachments": [
             {
                 "title": "I don't understand",
-                "text": "I didn't understand your command... try:\n"
-                        "• create <vm name> on <" + '|'.join(CLOUDS) + "|all>\n"
-                        "• list <" + '|'.join(CLOUDS) + "|all>\n"
-                        "• delete <vm name> on <" + '|'.join(CLOUDS) + "|all>\n",
+                "text": text + "\nTry:\n" + COMMANDS.help(),
                 "mrkdwn_in": [
                     "text"
                 ],
@@ -23,90 +67,142 @@ def i_dont_understand(payload):
             }
         ]
     }
-    resp = requests.post(payload["response_url"], json=response)
+    return response
+
+
+def expand_names(text):
+    """Expands VM names given as comma separated list and/or ranges (web-{1..3} is web-1, web-2, web-3).
+    Raises ValueError if there are no names or more than MAX_BATCH"""
+
+    names = []
+    for part in text.split(','):
+        part = part.strip()
+        m = NAME_RANGE.match(part) if '{' in part else None
+        if m:
+            prefix, start, end, suffix = m.groups()
+            # keep zero padding of ranges like {01..10}
+            width = len(start) if start.startswith('0') else 0
+            start, end = int(start), int(end)
+            if end - start >= MAX_BATCH:
+                raise ValueError("at most {} VMs can be handled at once".format(MAX_BATCH))
+            names.extend([prefix + str(i).zfill(width) + suffix for i in range(start, end + 1)])
+        elif part:
+            names.append(part)
+
+    # drop duplicates, keep order
+    names = list(OrderedDict.fromkeys(names))
+    if not names:
+        raise ValueError("no vm name")
+    if len(names) > MAX_BATCH:
+        raise ValueError("at most {} VMs can be handled at once".format(MAX_BATCH))
+    return names
+
+
+def describe_names(names):
+    """Short description of a list of VM names for slack messages"""
+
+    if len(names) == 1:
+        return names[0]
+    if len(names) <= 5:
+        return ', '.join(names)
+    return "{} VMs ({} … {})".format(len(names), names[0], names[-1])
+
+
+def post_response(response_url, response, budget=None, holder=None):
+    """Posts a message to the slack response_url of a command.  With a budget (see render.Budget) the message is
+    dropped if the command has no messages left"""
+
+    if budget is not None and not budget.take(holder=holder):
+        print("response not posted, no messages left: %s" % response)
+        return None
+    with metrics.span("slack_post"):
+        resp = transport.post(response_url, json=response)
     print("response[%s]: %s" % (resp.status_code, resp.text))
+    return resp
 
 
-def send_command(url, command, cloud, name=''):
-    """Sends a command to cloud handlers. supported commands: create, list, delete"""
+def run_function(url, function, input, secrets=None, blocking=True, timeout=None, retries=None):
+    """Runs a Dispatch function. Non-blocking runs return as soon as Dispatch accepted them"""
 
     payload = {
-        "blocking": True,
-        "input": {
-            "name": name,
-            "command": command
-        },
-        "secrets": [cloud]
+        "blocking": blocking,
+        "input": input
     }
-    print("%s/v1/runs?functionName=%s" % (url, cloud))
+    if secrets:
+        payload["secrets"] = secrets
+    print("%s/v1/runs?functionName=%s" % (url, function))
     print(payload)
 
-    return requests.post("%s/v1/runs?functionName=%s" % (url, cloud),
-                         headers={"Cookie": "cookie", "X-Dispatch-Org": "dispatch-server"},
-                         json=payload)
-
+    with metrics.span("dispatch_run", function=function, command=input.get("command", "")):
+        return transport.post("%s/v1/runs?functionName=%s" % (url, function),
+                              headers={"Cookie": "cookie", "X-Dispatch-Org": "dispatch-server"},
+                              json=payload, timeout=timeout, retries=retries)
 
-def create_vm(secrets, response_url, name, cloud):
-    """Creates a vm on a selected cloud and handles the response"""
 
-    resp = send_command(secrets['url'], 'create', cloud, name)
+def send_command(url, command, cloud, name='', timeout=None, names=None, function=None, request_id=None):
+    """Sends a command to cloud handlers. supported commands: create, list, delete.
+    Several VMs are sent as one batch if names has more than one name. The command is sent to the cloud's function,
+    unless another function is given. Raises breaker.BreakerOpen if the cloud is degraded"""
 
-    if resp.status_code == 200:
-        response = {
-            "response_type": "in_channel",
-            "attachments": [
-                {
-                    "title": "Create VM",
-                    "text": "VM creation on {} in progress".format(cloud),
-                    "mrkdwn_in": [
-                        "text"
-                    ],
-                    "color": "good"
-                }
-            ]
-        }
+    command_input = {
+        "name": name,
+        "command": command
+    }
+    if names:
+        if len(names) == 1:
+            command_input["name"] = names[0]
+        else:
+            command_input["names"] = names
+    if request_id:
+        command_input["requestId"] = request_id
+
+    # fails right away if the cloud is degraded, the timeout adapts to the cloud's recent latencies
+    cloud_breaker = breaker.get(cloud)
+    cloud_breaker.check()
+    limit = timeout if timeout is not None else fanout.DEFAULT_TIMEOUT
+    started = time.time()
+    try:
+        with metrics.span("cloud_command", cloud=cloud, command=command):
+            resp = run_function(url, function or cloud, command_input, secrets=[cloud],
+                                timeout=cloud_breaker.timeout(command, limit))
+    except Exception:
+        cloud_breaker.failure()
+        raise
+    if resp.status_code >= 500:
+        cloud_breaker.failure()
     else:
-        response = {
-            "attachments": [
-                {
-                    "title": "Create VM",
-                    "text": "VM creation on {} failed: [{}] {}".format(cloud, resp.status_code, resp.text),
-                    "mrkdwn_in": [
-                        "text"
-                    ],
-                    "color": "danger"
-                }
-            ]
-        }
-    resp = requests.post(response_url, json=response)
-    print("response[%s]: %s" % (resp.status_code, resp.text))
+        cloud_breaker.success(command, time.time() - started)
+    return resp
 
 
-def delete_vm(secrets, response_url, name, cloud):
-    """Deletes a vm on a selected cloud and handles the response"""
+def failures(resp, names):
+    """Returns [(name, error)] of the VMs a provider run failed for: its per-VM results with an "error" (results are in
+    the order of names), or all names if the whole command failed"""
 
-    resp = send_command(secrets['url'], 'delete', cloud, name)
+    try:
+        output = resp.json().get('output')
+        if isinstance(output, str):
+            # error replies of the providers are JSON strings
+            output = json.loads(output)
+    except (ValueError, AttributeError):
+        return []
+    if isinstance(output, dict) and output.get('error') and 'name' not in output:
+        return [(name, output['error']) for name in names]
+    results = output if isinstance(output, list) else [output]
+    return [(r.get('name') or name, r['error']) for name, r in zip(names, results)
+            if isinstance(r, dict) and r.get('error')]
 
-    if resp.status_code == 200:
-        response = {
-            "response_type": "in_channel",
-            "attachments": [
-                {
-                    "title": "Delete VM",
-                    "text": "VM deletion on {} in progress".format(cloud),
-                    "mrkdwn_in": [
-                        "text"
-                    ],
-                    "color": "good"
-                }
-            ]
-        }
-    else:
-        response = {
+
+def vms_response(title, action, names, cloud, resp):
+    """Returns (ok, slack message) reporting the response of a create or delete run, with the VMs it failed for"""
+
+    if resp.status_code != 200:
+        return False, {
             "attachments": [
                 {
-                    "title": "Delete VM",
-                    "text": "VM deletion on {} failed: [{}] {}".format(cloud, resp.status_code, resp.text),
+                    "title": title,
+                    "text": "VM {} of {} on {} failed: [{}] {}".format(
+                        action, describe_names(names), cloud, resp.status_code, resp.text),
                     "mrkdwn_in": [
                         "text"
                     ],
@@ -114,22 +210,91 @@ def delete_vm(secrets, response_url, name, cloud):
                 }
             ]
         }
-    resp = requests.post(response_url, json=response)
-    print("response[%s]: %s" % (resp.status_code, resp.text))
 
+    failed = failures(resp, names)
+    failed_names = set(name for name, _ in failed)
+    started = [name for name in names if name not in failed_names]
+    lines = []
+    if started:
+        lines.append("VM {} of {} on {} in progress".format(action, describe_names(started), cloud))
+    errors = set(error for _, error in failed)
+    if len(errors) == 1:
+        lines.append("VM {} of {} on {} failed: {}".format(
+            action, describe_names([name for name, _ in failed]), cloud, errors.pop()))
+    elif failed:
+        lines.append("VM {} of {} on {} failed:".format(action, describe_names([name for name, _ in failed]), cloud))
+        lines.extend("• {}: {}".format(name, error) for name, error in failed[:MAX_LISTED_FAILURES])
+        if len(failed) > MAX_LISTED_FAILURES:
+            lines.append("• … {} more".format(len(failed) - MAX_LISTED_FAILURES))
+    return not failed, {
+        "response_type": "in_channel",
+        "attachments": [
+            {
+                "title": title,
+                "text": "\n".join(lines),
+                "mrkdwn_in": [
+                    "text"
+                ],
+                "color": "danger" if not started else "warning" if failed else "good"
+            }
+        ]
+    }
+
+
+def create_vm(secrets, response_url, names, cloud, request_id=None, budget=None):
+    """Creates vms on a selected cloud and handles the response. Clouds create the vms of a request id only once"""
+
+    resp = send_command(secrets['url'], 'create', cloud, names=names, timeout=cloud_timeout(secrets),
+                        request_id=request_id)
+    inventory(secrets).invalidate(cloud)
+    ok, response = vms_response("Create VM", "creation", names, cloud, resp)
+    post_response(response_url, response, budget, cloud)
+    return ok
+
+
+def delete_vm(secrets, response_url, names, cloud, budget=None):
+    """Deletes vms on a selected cloud and handles the response"""
+
+    resp = send_command(secrets['url'], 'delete', cloud, names=names, timeout=cloud_timeout(secrets))
+    inventory(secrets).invalidate(cloud)
+    ok, response = vms_response("Delete VM", "deletion", names, cloud, resp)
+    post_response(response_url, response, budget, cloud)
+    return ok
+
+
+def inventory(secrets):
+    """Returns the inventory cache configured by the cloudmaster secret"""
+
+    return inventorycache.from_config(secrets.get('inventory', {}))
+
+
+def fetch_vms(secrets, cloud):
+    """Lists vms on a selected cloud"""
 
-def list_vm(secrets, response_url, cloud):
-    """List vms on a selected cloud and handles the response"""
+    resp = send_command(secrets['url'], 'list', cloud, timeout=cloud_timeout(secrets),
+                        function=LIST_FUNCTIONS.get(cloud))
+    if resp.status_code != 200:
+        raise Exception("[{}] {}".format(resp.status_code, resp.text))
+    return resp.json()['output']
 
-    resp = send_command(secrets['url'], 'list', cloud)
-    vms = resp.json()['output']
+
+def list_vm(secrets, response_url, cloud, filters=None, budget=None):
+    """List vms on a selected cloud and handles the response. Recently listed vms are served from the cache.
+    Large lists are split into several attachments and messages, as many as the budget of the command allows"""
+
+    budget = budget or render.Budget()
+
+    vms, age = inventory(secrets).get(cloud, functools.partial(fetch_vms, secrets))
+    if filters:
+        vms = [vm for vm in vms if render.matches(vm, filters)]
+    as_of = " (as of {:.0f}s ago)".format(age) if age >= 1 else ""
 
     if len(vms) == 0:
         response = {
             "response_type": "in_channel",
             "attachments": [
                 {
-                    "title": "Instances in cloud {}".format(cloud),
+                    "title": "Instances in cloud {}{}".format(cloud, as_of),
                     "text": "No instances",
                     "mrkdwn_in": [
                         "text"
@@ -138,93 +303,135 @@ def list_vm(secrets, response_url, cloud):
                 }
             ]
         }
-    else:
-        text = "```NAME\tSTATUS\n"
-        for vm in vms:
-            text += "{}\t{}\n".format(vm['name'], vm['status'])
-        text += "```"
+        post_response(response_url, response, budget, cloud)
+        return True
+
+    messages, left_out = render.pages(vms, render.columns(vms))
+    granted = budget.take(len(messages), holder=cloud)
+    if granted < len(messages):
+        messages, left_out = render.pages(vms, render.columns(vms), max_messages=granted)
+    if not messages:
+        print("instances in cloud {} not posted, no messages left".format(cloud))
+    for i, texts in enumerate(messages):
+        title = "Instances in cloud {}{}".format(cloud.upper(), as_of)
+        if len(messages) > 1:
+            title += " [{}/{}]".format(i + 1, len(messages))
+        attachments = [
+            {
+                "text": text,
+                "mrkdwn_in": [
+                    "text"
+                ],
+                "color": "good"
+            } for text in texts]
+        attachments[0]["title"] = title
+        if left_out and i == len(messages) - 1:
+            attachments[-1]["footer"] = "{} more instances not shown, narrow the list with filters".format(left_out)
         response = {
             "response_type": "in_channel",
+            "attachments": attachments
+        }
+        post_response(response_url, response)
+    return True
+
+
+def cloud_timeout(secrets):
+    """Returns the per-cloud timeout (in seconds) for provider runs"""
+
+    return float(secrets.get('timeout', fanout.DEFAULT_TIMEOUT))
+
+
+def all_clouds(secrets, payload, title, task):
+    """Runs task(cloud, budget) on all clouds concurrently. Posts failures as they land and a summary once all clouds
+    are done.  The messages of the response_url are shared by the clouds and the summary, each is guaranteed one"""
+
+    response_url = payload['response_url']
+    budget = render.Budget(holders=CLOUDS + ['summary'])
+
+    def report(outcome):
+        if outcome.status not in (fanout.ERROR, fanout.TIMEOUT):
+            # successful and failed runs were already posted by the task itself
+            return
+        if outcome.status == fanout.TIMEOUT:
+            text = "{} on {} timed out after {:.1f}s".format(title, outcome.cloud, outcome.elapsed)
+        else:
+            text = "{} on {} failed: {}".format(title, outcome.cloud, outcome.value)
+        response = {
             "attachments": [
                 {
-                    "title": "Instances in cloud {}".format(cloud.upper()),
+                    "title": title,
                     "text": text,
                     "mrkdwn_in": [
                         "text"
                     ],
-                    "color": "good"
+                    "color": "danger"
                 }
             ]
         }
+        post_response(response_url, response, budget, outcome.cloud)
 
-    resp = requests.post(response_url, json=response)
-    print("response[%s]: %s" % (resp.status_code, resp.text))
+    outcomes = fanout.fan_out(CLOUDS, lambda cloud: task(cloud, budget), timeout=cloud_timeout(secrets),
+                              on_outcome=report)
 
+    text = "\n".join("• {}: {} ({:.1f}s)".format(o.cloud, o.status, o.elapsed) for o in outcomes)
+    response = {
+        "response_type": "in_channel",
+        "attachments": [
+            {
+                "title": "{} on all clouds finished".format(title),
+                "text": text,
+                "mrkdwn_in": [
+                    "text"
+                ],
+                "color": "good" if all(o.status == fanout.OK for o in outcomes) else "warning"
+            }
+        ]
+    }
+    post_response(response_url, response, budget, 'summary')
+    return outcomes
 
-def create(secrets, payload):
-    """handles the create command provided to cloudmaster"""
 
-    r = re.compile(r"^(?P<command>create)\s(?P<name>.+)\s(on)\s(?P<cloud>.+)\s*$")
-    m = r.match(payload["text"])
-    if not m:
-        return i_dont_understand(payload)
+def create(secrets, payload, params):
+    """handles the create command provided to cloudmaster"""
 
-    params = m.groupdict()
-    name = params['name']
+    names = params['names']
     cloud = params['cloud']
-    if cloud not in ['all'] + CLOUDS:
-        return i_dont_understand(payload)
+    request_id = idempotency.request_key(payload)
 
     if cloud == 'all':
-        for c in CLOUDS:
-            create_vm(secrets, payload['response_url'], name, c)
+        all_clouds(secrets, payload, "Create VM",
+                   lambda c, budget: create_vm(secrets, payload['response_url'], names, c, request_id, budget))
     else:
-        create_vm(secrets, payload['response_url'], name, cloud)
+        create_vm(secrets, payload['response_url'], names, cloud, request_id)
 
 
-def list_instances(secrets, payload):
+def list_instances(secrets, payload, params):
     """Handles the list command provided to cloudmaster"""
 
-    r = re.compile(r"^(?P<command>list)\s(?P<cloud>.+)\s*$")
-    m = r.match(payload["text"])
-    if not m:
-        return i_dont_understand(payload)
-
-    params = m.groupdict()
     cloud = params['cloud']
-
-    if cloud not in ['all'] + CLOUDS:
-        return i_dont_understand(payload)
+    filters = params['filters']
 
     if cloud == 'all':
-        for c in CLOUDS:
-            list_vm(secrets, payload['response_url'], c)
+        all_clouds(secrets, payload, "List VMs",
+                   lambda c, budget: list_vm(secrets, payload['response_url'], c, filters, budget))
     else:
-        list_vm(secrets, payload['response_url'], cloud)
+        list_vm(secrets, payload['response_url'], cloud, filters)
 
 
-def delete(secrets, payload):
+def delete(secrets, payload, params):
     """Handles the delete command provided to cloudmaster"""
 
-    r = re.compile(r"^(?P<command>delete)\s(?P<name>.+)\s(on)\s(?P<cloud>.+)\s*$")
-    m = r.match(payload["text"])
-    if not m:
-        return i_dont_understand(payload)
-
-    params = m.groupdict()
-    name = params['name']
+    names = params['names']
     cloud = params['cloud']
-    if cloud not in ['all'] + CLOUDS:
-        return i_dont_understand(payload)
 
     if cloud == 'all':
-        for c in CLOUDS:
-            delete_vm(secrets, payload['response_url'], name, c)
+        all_clouds(secrets, payload, "Delete VM",
+                   lambda c, budget: delete_vm(secrets, payload['response_url'], names, c, budget))
     else:
-        delete_vm(secrets, payload['response_url'], name, cloud)
+        delete_vm(secrets, payload['response_url'], names, cloud)
 
 
-def echo(secrets, payload):
+def echo(secrets, payload, params):
     '''Pretty silly echo implementation which calls a sub-function to echo.
     '''
     echo = {
@@ -234,7 +441,7 @@ def echo(secrets, payload):
     print("%s/v1/runs?functionName=%s" % (secrets["url"], "echo"))
     print(echo)
 
-    resp = requests.post(
+    resp = transport.post(
         "%s/v1/runs?functionName=%s" % (secrets["url"], "echo"),
         headers={"Cookie": "cookie", "X-Dispatch-Org": "dispatch-server"},
         json=echo)
@@ -266,23 +473,134 @@ def echo(secrets, payload):
                 }
             ]
         }
-    resp = requests.post(payload["response_url"], json=response)
-    print("response[%s]: %s" % (resp.status_code, resp.text))
+    post_response(payload["response_url"], response)
 
 
-def handle(ctx, payload):
-    command_name = payload["text"].split()[0]
+CLOUD_CHOICES = '|'.join(CLOUDS) + '|all'
+
+COMMANDS = commands.Registry()
+COMMANDS.add("create", create, "create <vm name> on <" + CLOUD_CHOICES + ">",
+             r"^create\s+(?P<names>.+?)\s+on\s+(?P<cloud>\S+)$",
+             names=expand_names, cloud=commands.choice(['all'] + CLOUDS))
+COMMANDS.add("list", list_instances, "list <" + CLOUD_CHOICES + "> [status=<status>] [name=<pattern>]",
+             r"^list\s+(?P<cloud>\S+)(?P<filters>(?:\s+\S+)*)$",
+             cloud=commands.choice(['all'] + CLOUDS), filters=render.parse_filters)
+COMMANDS.add("delete", delete, "delete <vm name> on <" + CLOUD_CHOICES + ">",
+             r"^delete\s+(?P<names>.+?)\s+on\s+(?P<cloud>\S+)$",
+             names=expand_names, cloud=commands.choice(['all'] + CLOUDS))
+COMMANDS.add("echo", echo, None, r"^echo\b.*$")
+COMMANDS.notes.append("<vm name> can be a comma separated list or a range like web-{1..5}, "
+                      "up to " + str(MAX_BATCH) + " VMs")
+
+
+def acknowledge(payload):
+    """Reply to the slash command, sent while the command is still running"""
 
-    commands = {
-        "create": create,
-        "list": list_instances,
-        "delete": delete,
-        "echo": echo
+    return {
+        "response_type": "ephemeral",
+        "text": "Working on `{}`…".format(payload.get("text", "").strip())
     }
 
-    command = commands.get(command_name)
-    if command is None:
-        i_dont_understand(payload)
+
+def run_command(secrets, payload, command, params):
+    try:
+        command.handler(secrets, payload, params)
+    except Exception as e:
+        print("command %r failed: %s" % (payload.get("text"), e))
+        response = {
+            "attachments": [
+                {
+                    "title": "Error",
+                    "text": "`{}` failed: {}".format(payload.get("text", "").strip(), e),
+                    "mrkdwn_in": [
+                        "text"
+                    ],
+                    "color": "danger"
+                }
+            ]
+        }
+        post_response(payload["response_url"], response)
+
+
+def defer(secrets, payload, command, params):
+    """Starts a command without waiting for it. By default it is handed to a non-blocking run of the cloudmaster
+    function, with the "thread" defer mode (or if Dispatch can't be reached or rejects the run) it runs in a
+    background thread.
+
+    A run whose answer doesn't arrive in time may have been started already, it is not run locally as well: the
+    command would create or delete VMs twice"""
+
+    mode = secrets.get("defer", DEFER_DISPATCH)
+    if mode == DEFER_DISPATCH:
+        try:
+            resp = run_function(secrets["url"], secrets.get("function", FUNCTION_NAME), dict(payload, deferred=True),
+                                blocking=False, timeout=DEFER_TIMEOUT, retries=DEFER_RETRIES)
+            if resp.ok:
+                return
+            print("deferred run not accepted[%s]: %s" % (resp.status_code, resp.text))
+        except Exception as e:
+            if not transport.not_sent(e):
+                print("deferred run may have started, not running it here: %s" % e)
+                return
+            print("deferred run failed: %s" % e)
+
+    thread = threading.Thread(target=run_command, args=(secrets, payload, command, params),
+                              name="command-%s" % command.name)
+    thread.daemon = True
+    thread.start()
+
+
+def record_ack(command, started):
+    """Records the time it took to acknowledge a slash command"""
+
+    elapsed = time.time() - started
+    metrics.observe("ack", elapsed, command=command)
+    print("time-to-ack[%s]: %.1fms" % (command, elapsed * 1000))
+
+
+@metrics.instrumented('cloudmaster', command=lambda payload: COMMANDS.name(payload.get("text")))
+def handle(ctx, payload):
+    started = time.time()
+    secrets = ctx["secrets"]
+    transport.configure(**secrets.get("transport", {}))
+    breaker.configure(**secrets.get("breaker", {}))
+
+    try:
+        command, params = COMMANDS.parse(payload.get("text"))
+    except commands.ParseError as e:
+        record_ack("invalid", started)
+        return i_dont_understand(payload, e)
+
+    key = idempotency.request_key(payload)
+
+    if payload.get("deferred"):
+        # started by defer(), the slash command was already acknowledged
+        once(key and key + "/deferred", lambda: run_command(secrets, payload, command, params))
+        return {"text": "ok"}
+
+    if secrets.get("defer") == DEFER_NONE:
+        def start():
+            run_command(secrets, payload, command, params)
+            return {"text": "ok"}
     else:
-        command(ctx["secrets"], payload)
-    return {"text": "ok"}
\ No newline at end of file
+        def start():
+            defer(secrets, payload, command, params)
+            return acknowledge(payload)
+
+    try:
+        response = once(key, start)
+    except idempotency.InFlight:
+        response = {
+            "response_type": "ephemeral",
+            "text": "Still working on `{}`…".format(payload.get("text", "").strip())
+        }
+    record_ack(command.name, started)
+    return response
+
+
+def once(key, func):
+    """Runs func once per idempotency key, retries of a request get the result of the first run"""
+
+    if key is None:
+        return func()
+    return REQUESTS.run(key, func, timeout=DUPLICATE_WAIT)
@@ -0,0 +1,144 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Slash command grammar for cloudmaster.
+
+Commands are registered once, at import time, with a usage string, a regular expression (compiled right away) and
+argument converters.  Parsing a command is a dictionary lookup on its first word, a single match of its grammar and
+the conversion of the matched arguments.  Help is generated from the registered usages, and unknown commands or
+argument values get "did you mean" suggestions: words one typo (a missing, extra or wrong character, or two swapped
+ones) away from a command or value, looked up in an index built when they are registered.
+"""
+
+import re
+
+
+class ParseError(Exception):
+    """Raised for text which is not a valid command: ParseError(message[, suggestion]), suggestion is a corrected
+    command word or value, if any"""
+
+    # no __init__ of its own, the arguments are kept in args: raising is on the path of every invalid command
+
+    @property
+    def suggestion(self):
+        return self.args[1] if len(self.args) > 1 else None
+
+    def __str__(self):
+        return str(self.args[0]) if self.args else ''
+
+
+def _deletes(word):
+    return [word[:i] + word[i + 1:] for i in range(len(word))]
+
+
+class Suggestions(object):
+    """Index of known words by the words one typo away from them"""
+
+    def __init__(self, words=()):
+        self._index = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        # a typo of word and word share a string with at most one character deleted from each
+        for key in [word] + _deletes(word):
+            self._index.setdefault(key, word)
+
+    def get(self, word):
+        """Returns the known word one typo away from word, None if there is none"""
+
+        index = self._index
+        match = index.get(word)
+        if match is None:
+            for i in range(len(word)):
+                match = index.get(word[:i] + word[i + 1:])
+                if match is not None:
+                    break
+        return match
+
+
+def choice(values):
+    """Argument converter accepting one of values, suggesting the closest one otherwise"""
+
+    values = list(values)
+    accepted = frozenset(values)
+    suggestions = Suggestions(values)
+    expected = '|'.join(values)
+
+    def convert(value):
+        if value in accepted:
+            return value
+        raise ParseError("unknown value '{}', expected one of {}".format(value, expected), suggestions.get(value))
+
+    return convert
+
+
+class Command(object):
+    """A command, its grammar and the converters of its arguments"""
+
+    def __init__(self, name, handler, usage, pattern, converters):
+        self.name = name
+        self.handler = handler
+        self.usage = usage
+        self.regex = re.compile(pattern)
+        self.converters = converters
+        self._usage_error = "usage: {}".format(usage)
+
+    def parse(self, text):
+        m = self.regex.match(text)
+        if m is None:
+            raise ParseError(self._usage_error)
+        params = m.groupdict()
+        for arg, convert in self.converters.items():
+            try:
+                params[arg] = convert(params[arg])
+            except ParseError:
+                raise
+            except ValueError as e:
+                raise ParseError(str(e))
+        return params
+
+
+class Registry(object):
+    """Registered commands, looked up by their first word"""
+
+    def __init__(self):
+        self._commands = {}
+        self._suggestions = Suggestions()
+        self.notes = []
+
+    def add(self, name, handler, usage, pattern, **converters):
+        """Registers a command. pattern must match the whole (stripped) text, named groups are the arguments.
+        Commands without usage are left out of the help"""
+
+        command = Command(name, handler, usage, pattern, converters)
+        self._commands[name] = command
+        self._suggestions.add(name)
+        return command
+
+    def parse(self, text):
+        """Returns (command, params) for a command text, raises ParseError if it can't be parsed"""
+
+        text = (text or '').strip()
+        word = text.split(None, 1)[0] if text else ''
+        if not word:
+            raise ParseError("no command")
+        command = self._commands.get(word)
+        if command is None:
+            raise ParseError("unknown command '{}'".format(word), self._suggestions.get(word))
+        return command, command.parse(text)
+
+    def name(self, text):
+        """Returns the name of the command of text, "" if it is not a registered command"""
+
+        words = (text or '').split(None, 1)
+        return words[0] if words and words[0] in self._commands else ""
+
+    def help(self):
+        """Returns help text listing usages of all commands"""
+
+        lines = ["• {}".format(c.usage) for c in self._commands.values() if c.usage]
+        return "\n".join(lines + self.notes) + "\n"
@@ -0,0 +1,72 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Concurrent fan-out used by cloudmaster for "all" commands.
+
+Every cloud handler is a blocking Dispatch run, so running them one after another makes "all" commands as slow as the
+sum of all clouds.  fan_out() starts one worker per cloud and reports every outcome as soon as it lands, so the total
+wall time is roughly the time of the slowest cloud (bounded by the timeout).
+"""
+
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+
+DEFAULT_TIMEOUT = 60
+
+OK = 'ok'
+FAILED = 'failed'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+Outcome = namedtuple('Outcome', ['cloud', 'status', 'value', 'elapsed'])
+
+
+def fan_out(clouds, task, timeout=DEFAULT_TIMEOUT, on_outcome=None):
+    """Runs task(cloud) for every cloud in parallel and returns outcomes in completion order.
+
+    task should return a truthy value on success.  on_outcome is called from the calling thread for every outcome as
+    soon as it is known.  Clouds which do not finish within timeout seconds are reported with TIMEOUT status, their
+    workers are abandoned (not waited for).
+    """
+
+    outcomes = []
+    start = time.time()
+    deadline = start + timeout
+
+    def _report(outcome):
+        outcomes.append(outcome)
+        if on_outcome is not None:
+            on_outcome(outcome)
+
+    executor = ThreadPoolExecutor(max_workers=max(len(clouds), 1))
+    task = metrics.propagate(task)
+    pending = {executor.submit(task, cloud): cloud for cloud in clouds}
+    try:
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                cloud = pending.pop(future)
+                elapsed = time.time() - start
+                try:
+                    value = future.result()
+                except Exception as e:
+                    _report(Outcome(cloud, ERROR, e, elapsed))
+                    continue
+                _report(Outcome(cloud, OK if value else FAILED, value, elapsed))
+
+        for future, cloud in pending.items():
+            future.cancel()
+            _report(Outcome(cloud, TIMEOUT, None, time.time() - start))
+    finally:
+        executor.shutdown(wait=False)
+
+    return outcomes
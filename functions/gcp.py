@@ -24,6 +24,18 @@ cat << EOF > gcp.json
 
 EOF
 
+VMs are created in "zone".  To list the instances of more zones, add them to the secret (or the payload), e.g.
+"zones": ["us-west1-c", "europe-west1-b"], or "zones": "all" for all zones of the project.  Those are listed with a
+single aggregated listing.
+
+Instances are created from the image family debian-cloud/debian-9 as n1-standard-1 on the default network.  "image"
+(a family, "<project>/<family>" or a self-link), "machineType" and "network" in the secret or in the payload of a
+create change that, e.g.
+
+dispatch exec gcp --wait --input='{"command": "create", "name": "exampleVM", "image": "debian-cloud/debian-11"}'
+
+Their self-links are cached for an hour, also on disk (see resolvecache.py, "resolveCache" in the secret).
+
 Create a secret:
 
 dispatch create secret gcp gcp.json
@@ -40,49 +52,190 @@ dispatch create base-image python3-base dispatchframework/python3-base:0.0.13 --
 dispatch create image python-gcp python3-base --runtime-deps requirements.txt
 
 Create a function:
-dispatch create function python-gcp gcp gcp.py --secret gcp
+dispatch create function python-gcp gcp . --handler gcp.handle --secret gcp
 
 Execute it:
 dispatch exec gcp --wait --input='{"command": "create","name": "exampleVM"}'
 
+Cold starts are faster with a local copy of the compute API discovery document, which is otherwise fetched when the
+client is built:
+
+mkdir discovery
+curl -o discovery/compute.v1.json https://www.googleapis.com/discovery/v1/apis/compute/v1/rest
+
 """
 
-import time
+import functools
+import itertools
 import json
+import os
+from collections import namedtuple
+
+import clientcache
+import idempotency
+import locations
+import metrics
+import operations
+import resolvecache
+import status
+
+TRACKER = operations.Tracker()
+
+COMMANDS = ('create', 'list', 'delete')
+
+LABEL_FILTER = "labels.managedby=cloudmaster"
+
+# instances per list page, the maximum the compute API allows
+PAGE_SIZE = 500
+
+# requests per batch HTTP request, the maximum the compute API allows
+MAX_BATCH = 1000
+
+# statuses of batched requests which are retried by the next poll (None: no HTTP response)
+TRANSIENT_STATUSES = (None, 404, 429, 500, 502, 503, 504)
+
+DEFAULT_IMAGE = 'debian-cloud/debian-9'
+DEFAULT_MACHINE_TYPE = 'n1-standard-1'
+DEFAULT_NETWORK = 'default'
+
+# self-links of the image, machine type and network of created instances
+Resources = namedtuple('Resources', ['image', 'machine_type', 'network'])
+
+# local copy of the compute discovery document, saves fetching it on cold starts (see compute_client)
+DISCOVERY_DOCUMENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery', 'compute.v1.json')
+
+
+def _pages(collection, request, next_method, call):
+    """Yields the responses of a list request and of all the requests for its next pages"""
+
+    while request is not None:
+        with metrics.span('sdk', cloud='gcp', call=call):
+            response = request.execute()
+        yield response
+        request = getattr(collection, next_method)(previous_request=request, previous_response=response)
+
+
+def iter_instances(compute, project, zone):
+    """Yields instances managed by cloudmaster in a zone, pages are fetched lazily"""
+
+    instances = compute.instances()
+    request = instances.list(project=project, zone=zone, filter=LABEL_FILTER, maxResults=PAGE_SIZE)
+    for response in _pages(instances, request, 'list_next', 'instances.list'):
+        for instance in response.get('items', ()):
+            yield instance
+
+
+def list_instances(compute, project, zone, limit=None):
+    """Returns instances managed by cloudmaster in a zone, stops fetching pages once limit is reached"""
+
+    return list(itertools.islice(iter_instances(compute, project, zone), limit))
+
+
+def iter_zone_instances(compute, project, zones=locations.ALL):
+    """Yields instances managed by cloudmaster in zones (or all zones) with a single aggregated listing, pages are
+    fetched lazily.  Instances are tagged with their zone as location"""
+
+    instances = compute.instances()
+    request = instances.aggregatedList(project=project, filter=LABEL_FILTER, maxResults=PAGE_SIZE)
+    for response in _pages(instances, request, 'aggregatedList_next', 'instances.aggregatedList'):
+        # items are keyed by "zones/<zone>", zones without instances only carry a warning
+        for scope, scoped in sorted(response.get('items', {}).items()):
+            zone = scope.rpartition('/')[2]
+            if zones != locations.ALL and zone not in zones:
+                continue
+            for instance in scoped.get('instances', ()):
+                instance['location'] = zone
+                yield instance
+
+
+def list_zones(compute, project, zones, limit=None):
+    """Returns instances managed by cloudmaster in zones (or locations.ALL), stops fetching pages once limit is
+    reached"""
+
+    return list(itertools.islice(iter_zone_instances(compute, project, zones), limit))
+
+
+def _self_link(value):
+    # full URLs and partial paths ("projects/...", "zones/...", "global/...") are passed to the API as they are
+    return value.startswith(('https://', 'projects/', 'zones/', 'global/'))
+
+
+def resolve_image(compute, cache, project, image):
+    """Returns the self-link of image: "<project>/<family>" or "<family>" (of project) resolve to the latest image of
+    the family"""
+
+    if _self_link(image):
+        return image
+    image_project, _, family = image.rpartition('/')
+    image_project = image_project or project
+
+    def fetch():
+        with metrics.span('sdk', cloud='gcp', call='images.getFromFamily'):
+            return compute.images().getFromFamily(project=image_project, family=family).execute()['selfLink']
+
+    return cache.get('gcp:image:%s/%s' % (image_project, family), fetch)
+
+
+def resolve_machine_type(compute, cache, project, zone, machine_type):
+    """Returns the self-link of a machine type of zone, an unknown machine type fails before any instance is
+    created"""
+
+    if _self_link(machine_type):
+        return machine_type
+
+    def fetch():
+        with metrics.span('sdk', cloud='gcp', call='machineTypes.get'):
+            return compute.machineTypes().get(project=project, zone=zone,
+                                              machineType=machine_type).execute()['selfLink']
+
+    return cache.get('gcp:machineType:%s/%s/%s' % (project, zone, machine_type), fetch)
+
+
+def resolve_network(compute, cache, project, network):
+    """Returns the self-link of a network of project"""
+
+    if _self_link(network):
+        return network
+
+    def fetch():
+        with metrics.span('sdk', cloud='gcp', call='networks.get'):
+            return compute.networks().get(project=project, network=network).execute()['selfLink']
 
-import googleapiclient.discovery
-from google.oauth2 import service_account
+    return cache.get('gcp:network:%s/%s' % (project, network), fetch)
 
 
-def list_instances(compute, project, zone):
-    result = compute.instances().list(project=project, zone=zone, filter="labels.managedby=cloudmaster").execute()
-    if 'items' in result:
-        return result['items']
-    else:
-        return []
+def resolve(compute, secrets, project, zone, payload):
+    """Resolves the image, machine type and network of the payload (or the secret, or the defaults) to self-links,
+    served from the resolve cache configured by the secret"""
 
+    cache = resolvecache.from_config(secrets.get('resolveCache', {}))
 
-def create_instance(compute, project, zone, name):
-    image_response = compute.images().getFromFamily(
-        project='debian-cloud', family='debian-9').execute()
-    source_disk_image = image_response['selfLink']
+    def setting(key, default):
+        return payload.get(key) or secrets.get(key) or default
 
-    machine_type = "zones/%s/machineTypes/n1-standard-1" % zone
+    return Resources(
+        image=resolve_image(compute, cache, project, setting('image', DEFAULT_IMAGE)),
+        machine_type=resolve_machine_type(compute, cache, project, zone,
+                                          setting('machineType', DEFAULT_MACHINE_TYPE)),
+        network=resolve_network(compute, cache, project, setting('network', DEFAULT_NETWORK)),
+    )
 
-    config = {
+
+def instance_config(name, resources):
+    return {
         'name': name,
-        'machineType': machine_type,
+        'machineType': resources.machine_type,
         'disks': [
             {
                 'boot': True,
                 'autoDelete': True,
                 'initializeParams': {
-                    'sourceImage': source_disk_image,
+                    'sourceImage': resources.image,
                 }
             }
         ],
         'networkInterfaces': [{
-            'network': 'global/networks/default',
+            'network': resources.network,
             'accessConfigs': [
                 {'type': 'ONE_TO_ONE_NAT', 'name': 'External NAT'}
             ]
@@ -92,61 +245,224 @@ def create_instance(compute, project, zone, name):
         }
     }
 
-    return compute.instances().insert(
-        project=project,
-        zone=zone,
-        body=config).execute()
 
+def _request_args(request_id, name):
+    # GCP ignores a repeated insert with the same requestId and returns the operation of the first one
+    return {'requestId': idempotency.request_uuid(request_id, name)} if request_id else {}
 
-def delete_instance(compute, project, zone, name):
-    return compute.instances().delete(
+
+def create_instance(compute, project, zone, name, resources, request_id=None):
+    request = compute.instances().insert(
         project=project,
         zone=zone,
-        instance=name).execute()
+        body=instance_config(name, resources),
+        **_request_args(request_id, name))
+    with metrics.span('sdk', cloud='gcp', call='instances.insert'):
+        result = request.execute()
+    result['operation'] = operations.operation('gcp', 'create', name, result['name'])
+    return result
 
 
-# may not be needed
-def wait_for_operation(compute, project, zone, operation):
-    while True:
-        result = compute.zoneOperations().get(
+def delete_instance(compute, project, zone, name):
+    with metrics.span('sdk', cloud='gcp', call='instances.delete'):
+        result = compute.instances().delete(
             project=project,
             zone=zone,
-            operation=operation).execute()
+            instance=name).execute()
+    result['operation'] = operations.operation('gcp', 'delete', name, result['name'])
+    return result
+
+
+def execute_batch(compute, requests, http=None):
+    """Executes requests ({request id: request}) as batch HTTP requests of up to MAX_BATCH requests each.
+    Returns {request id: (response, exception)}"""
+
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    items = list(requests.items())
+    for start in range(0, len(items), MAX_BATCH):
+        batch = compute.new_batch_http_request(callback=callback)
+        for request_id, request in items[start:start + MAX_BATCH]:
+            batch.add(request, request_id=request_id)
+        with metrics.span('sdk', cloud='gcp', call='batch'):
+            batch.execute(http=http)
+    return results
+
+
+def _batch_results(kind, names, responses):
+    """Returns a result per name: the operation started, or the error of the request"""
+
+    results = []
+    for name in names:
+        response, exception = responses[name]
+        if exception is not None:
+            results.append({'name': name, 'error': str(exception)})
+        else:
+            response['operation'] = operations.operation('gcp', kind, name, response['name'])
+            results.append(response)
+    failed = [r['name'] for r in results if 'error' in r]
+    if failed:
+        print("{} failed for {} of {} instances: {}".format(kind, len(failed), len(names), ', '.join(failed)))
+    return results
+
+
+def create_instances(compute, project, zone, names, resources, request_id=None):
+    """Creates instances with a single batch request"""
+
+    responses = execute_batch(compute, {
+        name: compute.instances().insert(project=project, zone=zone,
+                                         body=instance_config(name, resources),
+                                         **_request_args(request_id, name))
+        for name in names})
+    return _batch_results('create', names, responses)
+
+
+def delete_instances(compute, project, zone, names):
+    """Deletes instances with a single batch request"""
+
+    responses = execute_batch(compute, {
+        name: compute.instances().delete(project=project, zone=zone, instance=name)
+        for name in names})
+    return _batch_results('delete', names, responses)
+
 
-        if result['status'] == 'DONE':
-            if 'error' in result:
-                raise Exception(result['error'])
-            return result
+def _operation_state(result):
+    if result['status'] == 'DONE':
+        return True, result.get('error')
+    return False, None
 
-        time.sleep(1)
+
+def poll_operation(compute, http, project, zone, op):
+    """Polls a zone operation, returns (done, error)"""
+
+    with metrics.span('sdk', cloud='gcp', call='zoneOperations.get'):
+        result = compute.zoneOperations().get(
+            project=project,
+            zone=zone,
+            operation=op['ref']).execute(http=http)
+    return _operation_state(result)
+
+
+def poll_operations(compute, http, project, zone, ops):
+    """Polls zone operations with batch requests, returns a (done, error) tuple per operation.
+    An operation whose status can't be fetched (not found yet, throttled, server error) is not done yet, other
+    errors fail it"""
+
+    if len(ops) == 1:
+        return [poll_operation(compute, http, project, zone, ops[0])]
+    responses = execute_batch(compute, {
+        str(i): compute.zoneOperations().get(project=project, zone=zone, operation=op['ref'])
+        for i, op in enumerate(ops)}, http=http)
+    states = []
+    for i in range(len(ops)):
+        response, exception = responses[str(i)]
+        if exception is None:
+            states.append(_operation_state(response))
+        elif _status(exception) in TRANSIENT_STATUSES:
+            states.append((False, None))
+        else:
+            states.append((True, str(exception)))
+    return states
+
+
+def _status(exception):
+    """Returns the HTTP status of an API error, None for other errors (e.g. a dropped connection)"""
+
+    resp = getattr(exception, 'resp', None)
+    try:
+        return int(getattr(resp, 'status', None))
+    except (TypeError, ValueError):
+        return None
 
 
 def gcp_creds(secret):
+    from google.oauth2 import service_account
     return service_account.Credentials.from_service_account_info(json.loads(secret))
 
 
+def credentials(secrets):
+    """Returns service account credentials, cached (with their access token) between invocations"""
+
+    return clientcache.get("gcp:credentials", secrets, lambda: gcp_creds(json.dumps(secrets)))
+
+
+def compute_client(secrets):
+    """Returns the compute API client. The client, its discovery document and access token are cached between
+    invocations of a warm function"""
+
+    def build():
+        # imported on first use, commands failing validation don't pay for loading the API client
+        import googleapiclient.discovery
+        if os.path.exists(DISCOVERY_DOCUMENT):
+            with open(DISCOVERY_DOCUMENT) as f:
+                return googleapiclient.discovery.build_from_document(f.read(), credentials=credentials(secrets))
+        try:
+            # google-api-python-client >= 2 ships discovery documents
+            return googleapiclient.discovery.build('compute', 'v1', credentials=credentials(secrets),
+                                                   cache_discovery=False, static_discovery=True)
+        except TypeError:
+            return googleapiclient.discovery.build('compute', 'v1', credentials=credentials(secrets),
+                                                   cache_discovery=False)
+
+    return clientcache.get("gcp:compute", secrets, build)
+
+
+def authorized_http(secrets):
+    """Returns a new authorized http object. httplib2 is not thread safe, requests made from background threads need
+    their own"""
+
+    import google_auth_httplib2
+    return google_auth_httplib2.AuthorizedHttp(credentials(secrets))
+
+
+@metrics.instrumented('gcp')
 def handle(ctx, payload):
     """
     entry point for GCP commands
     """
 
-    creds = gcp_creds(json.dumps(ctx['secrets']))
-    zone = ctx['secrets']['zone']
-    project = ctx['secrets']['project_id']
-
-    compute = googleapiclient.discovery.build('compute', 'v1', credentials=creds, cache_discovery=False)
-
     if 'command' not in payload:
         return _error('command is required')
     command = payload['command']
+    if command not in COMMANDS:
+        return {"error": "command {} is not supported".format(command)}
+    if command in ('create', 'delete') and 'name' not in payload and 'names' not in payload:
+        return _error('vm name is required')
+
+    zone = ctx['secrets']['zone']
+    project = ctx['secrets']['project_id']
+
+    compute = compute_client(ctx['secrets'])
 
-    result = {"error": "command {} is not supported".format(command)}
     if command == 'create':
-        result = create_instance(compute, project, zone, payload['name'])
+        resources = resolve(compute, ctx['secrets'], project, zone, payload)
+        if 'names' in payload:
+            result = create_instances(compute, project, zone, payload['names'], resources, payload.get('requestId'))
+        else:
+            result = create_instance(compute, project, zone, payload['name'], resources, payload.get('requestId'))
     if command == 'list':
-        result = list_instances(compute, project, zone)
+        zones = locations.requested(payload, ctx['secrets'], 'zones', zone)
+        if zones != locations.ALL and len(zones) == 1:
+            result = list_instances(compute, project, zones[0], payload.get('limit'))
+        else:
+            result = list_zones(compute, project, zones, payload.get('limit'))
     if command == 'delete':
-        result = delete_instance(compute, project, zone, payload['name'])
+        if 'names' in payload:
+            result = delete_instances(compute, project, zone, payload['names'])
+        else:
+            result = delete_instance(compute, project, zone, payload['name'])
+
+    if command in ('create', 'delete'):
+        ops = [r['operation'] for r in (result if isinstance(result, list) else [result]) if 'operation' in r]
+        if ops:
+            # all operations are polled together, the tracker thread needs its own http object
+            TRACKER.track_all(ops,
+                              functools.partial(poll_operations, compute, authorized_http(ctx['secrets']),
+                                                project, zone),
+                              status.notifier(ctx['secrets']))
 
     return result
 
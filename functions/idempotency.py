@@ -0,0 +1,121 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+De-duplication of retried slash commands.
+
+Slack retries slash commands it did not get an answer for in time.  A retry carries the same trigger_id (and
+response_url) as the original request, request_key() derives a key from them and the command text.  Store.run()
+executes a function once per key: duplicates arriving while it runs wait for it and get the same result, duplicates
+arriving later (within TTL seconds) get the remembered result.  Failures are not remembered, a retry runs again.
+
+The store is local to the process.  Retries which reach another container are caught by the providers: creates carry
+a request id, sent as ClientToken to EC2 and requestId to GCP (request_uuid()), so a repeated create returns the
+instances of the first one.
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+DEFAULT_TTL = 10 * 60
+DEFAULT_MAX_ENTRIES = 1000
+
+# namespace of the UUIDs derived from request ids
+NAMESPACE = uuid.UUID('5f0b7f4e-8f3a-4c86-9d2e-6a1f3c0d9b21')
+
+
+class InFlight(Exception):
+    """Raised if a duplicate gave up waiting for the original request"""
+
+
+def request_key(payload):
+    """Returns the idempotency key of a slash command payload, None if it has no trigger_id nor response_url"""
+
+    request = payload.get('trigger_id') or payload.get('response_url')
+    if not request:
+        return None
+    return hashlib.sha256(
+        ('%s\n%s' % (request, (payload.get('text') or '').strip())).encode('utf-8')).hexdigest()
+
+
+def request_uuid(request_id, name):
+    """Returns a UUID for a request and a VM name, the same one for every retry (GCP wants UUIDs as requestId)"""
+
+    return str(uuid.uuid5(NAMESPACE, '%s/%s' % (request_id, name)))
+
+
+class _Entry(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class Store(object):
+    """Results of requests by idempotency key, kept for ttl seconds after the request finished"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+        # the finished entries in finish order: requests finish out of order, and running ones are never evicted
+        self._finished = OrderedDict()
+
+    def _expire(self):
+        # called with the lock held, drops expired entries, then the oldest finished ones while over max_entries
+        now = self._clock()
+        while self._finished:
+            key, entry = next(iter(self._finished.items()))
+            if now - entry.finished_at < self.ttl and len(self._entries) <= self.max_entries:
+                break
+            del self._finished[key]
+            del self._entries[key]
+
+    def run(self, key, func, timeout=None):
+        """Returns func(), called once for all requests with the same key.
+        Duplicates wait up to timeout seconds for the original request, then raise InFlight"""
+
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            first = entry is None
+            if first:
+                entry = self._entries[key] = _Entry()
+
+        if not first:
+            if not entry.done.wait(timeout):
+                raise InFlight(key)
+            if entry.error is not None:
+                raise entry.error
+            return entry.result
+
+        try:
+            entry.result = func()
+        except Exception as e:
+            entry.error = e
+            raise
+        finally:
+            with self._lock:
+                entry.finished_at = self._clock()
+                if self._entries.get(key) is entry:
+                    if entry.error is None:
+                        self._finished[key] = entry
+                    else:
+                        # not remembered, a retry runs again
+                        del self._entries[key]
+            entry.done.set()
+        return entry.result
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._finished.pop(key, None)
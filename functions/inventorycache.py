@@ -0,0 +1,186 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Cache of cloud inventories (the output of the list command) used by cloudmaster.
+
+* entries younger than the cloud's TTL are served from the cache,
+* entries older than TTL but younger than max_stale are served from the cache as well, and a refresh is started in
+  the background (stale-while-revalidate),
+* older or missing entries are fetched synchronously,
+* invalidate() drops the entry of a cloud, cloudmaster does it after it creates or deletes VMs.
+
+Entries are kept by a backend: MemoryBackend (default) or SQLiteBackend, which keeps them in a local file so they
+survive restarts of the function.  Configuration comes from the "inventory" entry of the cloudmaster secret:
+
+{
+  "inventory": {
+    "backend": "sqlite",
+    "path": "/tmp/cloudmaster-inventory.db",
+    "ttl": 60,
+    "ttls": {"vsphere": 300},
+    "maxStale": 600
+  }
+}
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_STALE = 10 * 60
+DEFAULT_PATH = "/tmp/cloudmaster-inventory.db"
+
+
+class MemoryBackend(object):
+    """Keeps entries in process memory"""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, cloud):
+        return self._entries.get(cloud)
+
+    def put(self, cloud, vms, fetched_at):
+        self._entries[cloud] = (vms, fetched_at)
+
+    def delete(self, cloud):
+        self._entries.pop(cloud, None)
+
+
+class SQLiteBackend(object):
+    """Keeps entries in a local SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._db() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS inventory "
+                       "(cloud TEXT PRIMARY KEY, vms TEXT NOT NULL, fetched_at REAL NOT NULL)")
+
+    @contextmanager
+    def _db(self):
+        # connections can't be shared between threads, a connection per call is cheap for a local file
+        with self._lock:
+            db = sqlite3.connect(self.path, timeout=5)
+            try:
+                with db:
+                    yield db
+            finally:
+                db.close()
+
+    def get(self, cloud):
+        with self._db() as db:
+            row = db.execute("SELECT vms, fetched_at FROM inventory WHERE cloud = ?", (cloud,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, cloud, vms, fetched_at):
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO inventory (cloud, vms, fetched_at) VALUES (?, ?, ?)",
+                       (cloud, json.dumps(vms), fetched_at))
+
+    def delete(self, cloud):
+        with self._db() as db:
+            db.execute("DELETE FROM inventory WHERE cloud = ?", (cloud,))
+
+
+class InventoryCache(object):
+    """Serves inventories from a backend, refreshing them with fetch(cloud)"""
+
+    def __init__(self, backend, ttl=DEFAULT_TTL, ttls=None, max_stale=DEFAULT_MAX_STALE, clock=time.time):
+        self.backend = backend
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.max_stale = max_stale
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._generations = {}
+
+    def refresh(self, cloud, fetch):
+        """Fetches the inventory of a cloud and stores it, unless the cloud was invalidated in the meantime"""
+
+        generation = self._generations.get(cloud, 0)
+        fetched_at = self._clock()
+        vms = fetch(cloud)
+        with self._lock:
+            if self._generations.get(cloud, 0) == generation:
+                self.backend.put(cloud, vms, fetched_at)
+        return vms
+
+    def _refresh_in_background(self, cloud, fetch):
+        with self._lock:
+            if cloud in self._refreshing:
+                return
+            self._refreshing.add(cloud)
+
+        def run():
+            try:
+                self.refresh(cloud, fetch)
+            except Exception as e:
+                print("refresh of %s inventory failed: %s" % (cloud, e))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(cloud)
+
+        thread = threading.Thread(target=run, name="refresh-%s" % cloud)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, cloud, fetch):
+        """Returns (vms, age in seconds) of a cloud's inventory, age is 0 if it was just fetched"""
+
+        entry = self.backend.get(cloud)
+        if entry is not None:
+            vms, fetched_at = entry
+            age = self._clock() - fetched_at
+            if age < self.ttls.get(cloud, self.ttl):
+                return vms, age
+            if age < self.max_stale:
+                self._refresh_in_background(cloud, fetch)
+                return vms, age
+
+        return self.refresh(cloud, fetch), 0
+
+    def invalidate(self, cloud):
+        """Drops the cached inventory of a cloud"""
+
+        with self._lock:
+            self._generations[cloud] = self._generations.get(cloud, 0) + 1
+            self.backend.delete(cloud)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def from_config(config):
+    """Returns the inventory cache for a configuration (see module docs), the same one for equal configurations"""
+
+    key = json.dumps(config, sort_keys=True)
+    with _caches_lock:
+        return _caches.get(key) or _new_cache(key, config)
+
+
+def backend(config):
+    """Returns a new backend for a configuration (see module docs)"""
+
+    if config.get("backend", "memory") == "sqlite":
+        return SQLiteBackend(config.get("path", DEFAULT_PATH))
+    return MemoryBackend()
+
+
+def _new_cache(key, config):
+    cache = InventoryCache(backend(config),
+                           ttl=config.get("ttl", DEFAULT_TTL),
+                           ttls=config.get("ttls"),
+                           max_stale=config.get("maxStale", DEFAULT_MAX_STALE))
+    _caches[key] = cache
+    return cache
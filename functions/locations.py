@@ -0,0 +1,91 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Queries across the regions (or zones) of a cloud.
+
+A provider function lists the locations given in its payload or secret, e.g.
+
+{"command": "list", "regions": ["us-west-2", "us-east-1"]}
+
+or "all" of them.  query() runs a per-location task on a bounded thread pool and streams the instances of every
+location, tagged with it, as soon as its task finishes, so a consumer with a limit stops early and the total time is
+roughly the time of the slowest location (not the sum of all of them).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+import metrics
+
+ALL = 'all'
+
+# locations queried at the same time
+MAX_WORKERS = 8
+
+# seconds to wait for all locations of a query
+DEFAULT_TIMEOUT = 60
+
+
+class LocationsFailed(Exception):
+    """Raised when no location of a query could be listed"""
+
+
+def requested(payload, secrets, key, default):
+    """Returns the locations of key ("regions", "zones") in the payload, else in the secret, else [default].
+    Returns ALL if "all" locations are requested"""
+
+    value = payload.get(key) or secrets.get(key) or [default]
+    if value == ALL or value == [ALL]:
+        return ALL
+    if isinstance(value, str):
+        value = [v.strip() for v in value.split(',') if v.strip()]
+    return list(value)
+
+
+def query(locations, task, max_workers=MAX_WORKERS, timeout=DEFAULT_TIMEOUT, key='location'):
+    """Runs task(location), returning an iterable of instances, for every location on a thread pool of max_workers.
+    Yields the instances of locations in completion order, each tagged with its location under key.
+
+    Locations failing (or not done within timeout seconds) are logged and left out.  LocationsFailed is raised if
+    all of them fail.  Closing the generator early abandons the locations still pending.
+    """
+
+    if not locations:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(locations)))
+    cancelled = threading.Event()
+
+    def run(location):
+        # pending locations are skipped once the consumer is gone
+        if cancelled.is_set():
+            return []
+        return list(task(location))
+
+    run = metrics.propagate(run)
+    futures = {executor.submit(run, location): location for location in locations}
+    failed = []
+    try:
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                location = futures[future]
+                try:
+                    instances = future.result()
+                except Exception as e:
+                    print("listing {} failed: {}".format(location, e))
+                    failed.append(str(e))
+                    continue
+                for instance in instances:
+                    instance[key] = location
+                    yield instance
+        except TimeoutError:
+            pending = [location for future, location in futures.items() if not future.done()]
+            print("listing {} timed out".format(', '.join(pending)))
+            failed.extend('timed out' for _ in pending)
+        if len(failed) == len(locations):
+            raise LocationsFailed("listing all of {} failed: {}".format(', '.join(locations), failed[0]))
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False)
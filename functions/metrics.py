@@ -0,0 +1,263 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Latency metrics shared by all functions.
+
+span() times a block (an SDK call, a Dispatch run, a slack post) into a histogram per span name and labels, e.g.
+cloud and command.  Histograms live in module globals and accumulate over warm invocations; exposition() renders them
+in the Prometheus text format, functions return it for the "metrics" command:
+
+dispatch exec aws --wait --input='{"command": "metrics"}'
+
+invocation() wraps a whole invocation, instrumented() does that (and answers the "metrics" command) for the handle
+function of a Dispatch function.  When it ends, a JSON line with its duration and the count and total time of
+the spans it contains is printed, e.g.
+
+{"metrics": "invocation", "function": "aws", "command": "list", "ms": 812.4, "spans": {"sdk": {"count": 1, ...}}}
+
+A span costs a couple of microseconds, nothing when metrics are switched off.  Settings can be changed with
+configure(), e.g. from the "metrics" entry of a secret:
+
+{
+  "metrics": {
+    "enabled": true,
+    "log": false
+  }
+}
+"""
+
+import functools
+import json
+import threading
+from bisect import bisect_left
+from timeit import default_timer
+
+# histogram bucket bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+PREFIX = 'cloudmaster'
+
+DEFAULTS = {
+    "enabled": True,
+    "log": True,
+}
+
+_settings = dict(DEFAULTS)
+_histograms = {}
+_lock = threading.Lock()
+# the innermost running invocation of each thread
+_local = threading.local()
+
+
+def configure(**settings):
+    """Updates metrics settings, recorded histograms are kept"""
+
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("unknown metrics settings: %s" % ', '.join(sorted(unknown)))
+    _settings.update(settings)
+
+
+def reset():
+    """Restores default settings and drops all recorded histograms"""
+
+    with _lock:
+        _settings.clear()
+        _settings.update(DEFAULTS)
+        _histograms.clear()
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _observe(name, labels, value):
+    key = (name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+        invocation = getattr(_local, 'invocation', None)
+        if invocation is not None:
+            invocation.add(name, value)
+
+
+def observe(name, value, **labels):
+    """Records a value (in seconds) in the histogram of name and labels"""
+
+    if _settings["enabled"]:
+        _observe(name, tuple(sorted(labels.items())), value)
+
+
+class _Span(object):
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        _observe(self.name, self.labels, default_timer() - self.started)
+        return False
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+def span(name, **labels):
+    """Returns a context manager timing its block into the histogram of name and labels"""
+
+    if not _settings["enabled"]:
+        return NO_SPAN
+    return _Span(name, tuple(sorted(labels.items())))
+
+
+class _Invocation(object):
+
+    def __init__(self, function, command):
+        self.function = function
+        self.command = command
+        self.spans = {}
+        self.started = None
+        self.previous = None
+
+    def add(self, name, value):
+        entry = self.spans.get(name)
+        if entry is None:
+            entry = self.spans[name] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += value
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'invocation', None)
+        _local.invocation = self
+        self.started = default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = default_timer() - self.started
+        _local.invocation = self.previous
+        observe("invocation", elapsed, function=self.function, command=self.command)
+        with _lock:
+            # workers abandoned by a fan-out may still add spans
+            spans = sorted((name, tuple(entry)) for name, entry in self.spans.items())
+        if _settings["log"]:
+            print(json.dumps({
+                "metrics": "invocation",
+                "function": self.function,
+                "command": self.command,
+                "ms": round(elapsed * 1000, 1),
+                "spans": {name: {"count": count, "ms": round(total * 1000, 1)}
+                          for name, (count, total) in spans},
+            }, sort_keys=True))
+        return False
+
+
+def invocation(function, command=""):
+    """Returns a context manager timing a function invocation and logging its spans when it ends.
+    Spans are counted to the innermost invocation running in their thread, see propagate() for worker threads"""
+
+    if not _settings["enabled"]:
+        return NO_SPAN
+    return _Invocation(function, command)
+
+
+def propagate(func):
+    """Returns func wrapped to count its spans to the invocation running in the calling thread, for functions run by
+    worker threads"""
+
+    invocation = getattr(_local, 'invocation', None)
+    if invocation is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'invocation', None)
+        _local.invocation = invocation
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.invocation = previous
+
+    return wrapper
+
+
+def _payload_command(payload):
+    return payload.get("command", "") if isinstance(payload, dict) else ""
+
+
+def instrumented(function, command=_payload_command):
+    """Decorator for the handle function of a Dispatch function: applies the "metrics" settings of its secrets,
+    returns exposition() for the "metrics" command and wraps other commands in an invocation labeled with
+    command(payload)"""
+
+    def decorator(handle):
+        @functools.wraps(handle)
+        def wrapper(ctx, payload):
+            configure(**(ctx.get("secrets") or {}).get("metrics", {}))
+            label = command(payload)
+            if _payload_command(payload) == "metrics":
+                return exposition()
+            with invocation(function, label):
+                return handle(ctx, payload)
+        return wrapper
+
+    return decorator
+
+
+def _format_labels(labels, le=None):
+    pairs = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]
+    if le is not None:
+        pairs.append('le="{}"'.format(le))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def exposition():
+    """Returns all histograms in the Prometheus text exposition format"""
+
+    with _lock:
+        snapshot = sorted((key, list(h.counts), h.sum, h.count) for key, h in _histograms.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), counts, total, count in snapshot:
+        metric = '%s_%s_seconds' % (PREFIX, name)
+        if metric not in typed:
+            typed.add(metric)
+            lines.append('# TYPE %s histogram' % metric)
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (metric, _format_labels(labels, bound), cumulative))
+        lines.append('%s_sum%s %r' % (metric, _format_labels(labels), total))
+        lines.append('%s_count%s %d' % (metric, _format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
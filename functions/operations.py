@@ -0,0 +1,124 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Tracking of long running cloud operations (VM creation and deletion).
+
+Cloud handlers start an operation, return its handle right away and let a Tracker poll the operation in a
+background thread.  Polling backs off (INITIAL_DELAY, growing by BACKOFF up to MAX_DELAY seconds) and gives up after
+TIMEOUT seconds.  Completion, failure or timeout is reported with notify(message), usually status.notifier(), which
+posts to the slack statusUrl.
+
+A poll function returns a (done, error) tuple, error being None on success.  A poll function raising an exception (or
+returning (False, None) for an operation it can't see yet) is retried until TIMEOUT.  Operations started together can be
+tracked together with track_all(), their poll function checks all pending ones at once (e.g. in a batch request).
+"""
+
+import threading
+import time
+
+INITIAL_DELAY = 1.0
+MAX_DELAY = 30.0
+BACKOFF = 1.5
+TIMEOUT = 30 * 60
+
+
+def operation(cloud, kind, name, ref=None):
+    """Returns a (JSON serializable) handle of a started operation"""
+
+    return {
+        "cloud": cloud,
+        "kind": kind,
+        "name": name,
+        "ref": ref,
+        "started": time.time(),
+    }
+
+
+def describe(op):
+    return "{} of {} on {}".format(op["kind"], op["name"], op["cloud"])
+
+
+class Tracker(object):
+    """Polls operations with adaptive backoff until they are done"""
+
+    def __init__(self, initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY, backoff=BACKOFF, timeout=TIMEOUT,
+                 sleep=time.sleep, clock=time.time):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self._sleep = sleep
+        self._clock = clock
+
+    def wait(self, op, poll, notify):
+        """Polls until the operation is done, failed or timed out. Returns (done, error)"""
+
+        return self.wait_all([op], lambda ops: [poll()], notify)[0]
+
+    def wait_all(self, ops, poll, notify):
+        """Polls operations together until each of them is done, failed or timed out.  poll(ops) returns a
+        (done, error) tuple per operation of ops, it is only passed the operations still pending.
+        Returns a (done, error) tuple per operation.
+
+        An exception raised by poll (e.g. an instance not visible yet right after its creation, a throttled or failed
+        API call) doesn't end the operations, polling is retried with backoff until the timeout"""
+
+        deadline = self._clock() + self.timeout
+        delay = self.initial_delay
+        results = [None] * len(ops)
+        pending = list(range(len(ops)))
+        last_error = None
+        while True:
+            try:
+                states = poll([ops[i] for i in pending])
+                last_error = None
+            except Exception as e:
+                print("polling {} operations failed, retrying: {}".format(len(pending), e))
+                states = [(False, None)] * len(pending)
+                last_error = e
+
+            still_pending = []
+            for i, (done, error) in zip(pending, states):
+                if not done:
+                    still_pending.append(i)
+                    continue
+                if error:
+                    notify("{} failed: {}".format(describe(ops[i]), error))
+                else:
+                    notify("{} finished after {:.0f}s".format(describe(ops[i]), self._clock() - ops[i]["started"]))
+                results[i] = (done, error)
+            pending = still_pending
+            if not pending:
+                return results
+
+            if self._clock() + delay > deadline:
+                for i in pending:
+                    notify("{} did not finish within {:.0f}s{}".format(
+                        describe(ops[i]), self.timeout, ": {}".format(last_error) if last_error else ""))
+                    results[i] = (False, None)
+                return results
+
+            self._sleep(delay)
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def track(self, op, poll, notify):
+        """Polls the operation in a background thread and returns its handle immediately"""
+
+        thread = threading.Thread(target=self.wait, args=(op, poll, notify),
+                                  name="track-{}".format(describe(op)))
+        thread.daemon = True
+        thread.start()
+        return op
+
+    def track_all(self, ops, poll, notify):
+        """Polls operations together in a single background thread (see wait_all) and returns their handles
+        immediately"""
+
+        thread = threading.Thread(target=self.wait_all, args=(ops, poll, notify),
+                                  name="track-{} operations".format(len(ops)))
+        thread.daemon = True
+        thread.start()
+        return ops
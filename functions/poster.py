@@ -0,0 +1,217 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Batched posting of status messages to a slack webhook.
+
+A deployment wave produces hundreds of status messages within seconds, posting each one separately runs into slack's
+rate limits.  A Poster coalesces the messages arriving within a short window into one digest message, posted over the
+pooled transport:
+
+* a 429 response is retried after its Retry-After (messages arriving meanwhile join the digest),
+* failed posts are retried with backoff,
+* queued messages are kept in a local spool file until they are posted, messages left over by a previous process
+  (e.g. a function container stopped during a burst) are posted by the next one.
+
+Configuration comes from the "statusDigest" entry of a secret:
+
+{
+  "statusDigest": {
+    "window": 2,
+    "maxMessages": 50,
+    "spoolDir": "/tmp"
+  }
+}
+
+A null spoolDir keeps messages in memory only.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import metrics
+
+DEFAULT_WINDOW = 2.0
+MAX_MESSAGES = 50
+# slack truncates longer messages
+MAX_CHARS = 3500
+DEFAULT_SPOOL_DIR = "/tmp"
+
+DEFAULT_RETRY_AFTER = 1.0
+MAX_DELAY = 60.0
+
+
+def _post(url, text):
+    # imported on first use, provider functions import this module on their cold path
+    import transport
+    with metrics.span("slack_post", target="status"):
+        return transport.post(url, json={"text": text})
+
+
+def digest(messages):
+    """Returns the text of a digest of messages"""
+
+    if len(messages) == 1:
+        return messages[0]
+    return "%d updates:\n%s" % (len(messages), "\n".join(messages))
+
+
+def retry_after(resp):
+    """Returns the seconds to wait before posting again after a 429 response"""
+
+    try:
+        return max(float(resp.headers.get("Retry-After", DEFAULT_RETRY_AFTER)), 0.0)
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+class Poster(object):
+    """Posts messages to a slack webhook url as digests, from a background thread"""
+
+    def __init__(self, url, window=DEFAULT_WINDOW, max_messages=MAX_MESSAGES, spool=None, post=_post,
+                 sleep=time.sleep):
+        self.url = url
+        self.window = window
+        self.max_messages = max_messages
+        self.spool = spool
+        self._post = post
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._queue = self._load()
+        if self._queue:
+            print("posting %d spooled status messages" % len(self._queue))
+            with self._lock:
+                self._start()
+
+    def _load(self):
+        if not self.spool or not os.path.exists(self.spool):
+            return []
+        messages = []
+        try:
+            with open(self.spool) as f:
+                for line in f:
+                    try:
+                        messages.append(json.loads(line))
+                    except ValueError:
+                        # a line cut short by a crash
+                        pass
+        except (IOError, OSError) as e:
+            print("can't read status spool: %s" % e)
+        return messages
+
+    def _rewrite_spool(self):
+        # called with the lock held, the file is replaced atomically
+        if not self.spool:
+            return
+        tmp = self.spool + ".tmp"
+        with open(tmp, "w") as f:
+            for message in self._queue:
+                f.write(json.dumps(message) + "\n")
+        os.replace(tmp, self.spool)
+
+    def post(self, message):
+        """Queues a message, it is posted with the other messages of the window"""
+
+        with self._lock:
+            self._queue.append(message)
+            if self.spool:
+                try:
+                    with open(self.spool, "a") as f:
+                        f.write(json.dumps(message) + "\n")
+                except (IOError, OSError) as e:
+                    print("can't spool status message: %s" % e)
+            self._start()
+
+    def pending(self):
+        """Returns the number of messages not posted yet"""
+
+        with self._lock:
+            return len(self._queue)
+
+    def _start(self):
+        # called with the lock held
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run, name="status-poster")
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _batch(self):
+        # called with the lock held, the first messages fitting in a digest
+        batch = []
+        size = 0
+        for message in self._queue[:self.max_messages]:
+            if batch and size + len(message) + 1 > MAX_CHARS:
+                break
+            batch.append(message)
+            size += len(message) + 1
+        return batch
+
+    def _run(self):
+        delay = self.window
+        failures = 0
+        while True:
+            self._sleep(delay)
+            with self._lock:
+                batch = self._batch()
+                if not batch:
+                    self._flusher = None
+                    return
+
+            try:
+                resp = self._post(self.url, digest(batch))
+            except Exception as e:
+                resp = None
+                print("status post failed: %s" % e)
+
+            if resp is not None and resp.status_code == 429:
+                delay = retry_after(resp)
+                print("status posts rate limited, retrying %d messages in %.0fs" % (len(batch), delay))
+                continue
+            if resp is None or resp.status_code >= 500:
+                failures += 1
+                delay = min(self.window * 2 ** failures, MAX_DELAY)
+                continue
+
+            failures = 0
+            delay = self.window
+            if not resp.ok:
+                # the webhook rejects the message itself (e.g. revoked url), retrying won't help
+                print("status post failed[%s]: %s, dropped %d messages" % (resp.status_code, resp.text, len(batch)))
+            with self._lock:
+                del self._queue[:len(batch)]
+                try:
+                    self._rewrite_spool()
+                except (IOError, OSError) as e:
+                    print("can't update status spool: %s" % e)
+
+
+_posters = {}
+_posters_lock = threading.Lock()
+
+
+def spool_path(spool_dir, url):
+    """Returns the spool file of a webhook url"""
+
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(spool_dir, "cloudmaster-status-%s.spool" % key)
+
+
+def for_url(url, config=None):
+    """Returns the poster of a webhook url, configured by config (see module docs) when it is first used"""
+
+    config = config or {}
+    with _posters_lock:
+        poster = _posters.get(url)
+        if poster is None:
+            spool_dir = config.get("spoolDir", DEFAULT_SPOOL_DIR)
+            poster = _posters[url] = Poster(url,
+                                            window=config.get("window", DEFAULT_WINDOW),
+                                            max_messages=config.get("maxMessages", MAX_MESSAGES),
+                                            spool=spool_path(spool_dir, url) if spool_dir else None)
+        return poster
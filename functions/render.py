@@ -0,0 +1,125 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Rendering of instance lists for slack.
+
+Tables are built with a single join, columns are aligned and rows sorted.  Slack truncates long attachments, so
+tables are split into attachments of at most MAX_ATTACHMENT_CHARS and those into messages of at most
+MAX_ATTACHMENTS attachments.  A response_url only accepts MAX_RESPONSES messages, a Budget shares them between the
+posts of a command (e.g. the clouds of "list all" and its summary).  Rows beyond the messages a list can use are left
+out (and counted in its last message).
+"""
+
+import fnmatch
+import threading
+
+MAX_ATTACHMENT_CHARS = 6000
+MAX_ATTACHMENTS = 5
+# messages of a single list
+MAX_MESSAGES = 2
+# messages slack accepts per response_url
+MAX_RESPONSES = 5
+
+COLUMNS = ('name', 'status')
+
+
+def columns(vms):
+    """Returns COLUMNS, plus the location of vms listed from several regions or zones"""
+
+    if any('location' in vm for vm in vms):
+        return COLUMNS + ('location',)
+    return COLUMNS
+
+
+def parse_filters(text):
+    """Parses filters like "status=running name=web-*" into a dict"""
+
+    filters = {}
+    for part in text.split():
+        key, sep, value = part.partition('=')
+        if not sep or not key or not value:
+            raise ValueError("invalid filter: %s" % part)
+        filters[key.lower()] = value.lower()
+    return filters
+
+
+def matches(vm, filters):
+    """True if all filters match the vm, filter values can be glob patterns"""
+
+    for key, pattern in filters.items():
+        value = vm.get(key)
+        if value is None or not fnmatch.fnmatchcase(str(value).lower(), pattern):
+            return False
+    return True
+
+
+def table_rows(vms, columns=COLUMNS, sort_by='name'):
+    """Returns the header and rows of vms as column aligned lines, rows are sorted"""
+
+    rows = sorted(([str(vm.get(c, '')) for c in columns] for vm in vms),
+                  key=lambda row: row[columns.index(sort_by)] if sort_by in columns else row)
+    header = [c.upper() for c in columns]
+    widths = [max(len(cell) for cell in cells) for cells in zip(header, *rows)]
+    fmt = '  '.join('{:<%d}' % w for w in widths[:-1]) + ('  {}' if len(widths) > 1 else '{}')
+
+    return fmt.format(*header), [fmt.format(*row).rstrip() for row in rows]
+
+
+def chunks(header, rows, max_chars=MAX_ATTACHMENT_CHARS):
+    """Splits rows into code blocks of at most max_chars, each starting with the header"""
+
+    blocks = []
+    block = [header]
+    size = len(header) + 7
+    for row in rows:
+        if size + len(row) + 1 > max_chars and len(block) > 1:
+            blocks.append(block)
+            block = [header]
+            size = len(header) + 7
+        block.append(row)
+        size += len(row) + 1
+    blocks.append(block)
+    return ["```" + "\n".join(block) + "```" for block in blocks]
+
+
+def pages(vms, columns=COLUMNS, sort_by='name', max_messages=MAX_MESSAGES):
+    """Returns a list of at most max_messages messages, each a list of attachment texts, and the number of rows left
+    out"""
+
+    header, rows = table_rows(vms, columns, sort_by)
+    texts = chunks(header, rows)
+    messages = [texts[i:i + MAX_ATTACHMENTS] for i in range(0, len(texts), MAX_ATTACHMENTS)]
+    if len(messages) <= max_messages:
+        return messages, 0
+
+    shown = messages[:max_messages]
+    shown_rows = sum(text.count("\n") for message in shown for text in message)
+    return shown, len(rows) - shown_rows
+
+
+class Budget(object):
+    """The messages a command can still post to its response_url.
+
+    Holders (e.g. the clouds of an "all" command and its summary) are each guaranteed one message, the others are
+    taken first come, first served.
+    """
+
+    def __init__(self, messages=MAX_RESPONSES, holders=()):
+        self._lock = threading.Lock()
+        self._shares = set(holders)
+        self._free = messages - len(self._shares)
+
+    def take(self, wanted=1, holder=None):
+        """Takes up to wanted messages, including the share of holder, and returns the number taken.  A holder's
+        share is used up by its first take"""
+
+        with self._lock:
+            if holder in self._shares:
+                self._shares.discard(holder)
+                self._free += 1
+            taken = max(min(wanted, self._free), 0)
+            self._free -= taken
+            return taken
@@ -0,0 +1,131 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Cache of resolved names, e.g. image families, machine types and networks resolved to self-links.
+
+Those answers change rarely, but resolving them is a blocking API call in front of every create.  Entries are kept
+for a TTL in process memory and, with a path, in a local JSON file so they survive restarts of the function.
+Concurrent lookups of the same name share one resolution: 20 concurrent creates resolve their image once.
+Configuration comes from the "resolveCache" entry of a secret:
+
+{
+  "resolveCache": {
+    "ttl": 3600,
+    "path": "/tmp/cloudmaster-resolve.json"
+  }
+}
+
+A null path keeps entries in memory only.
+"""
+
+import json
+import os
+import threading
+import time
+
+DEFAULT_TTL = 60 * 60
+DEFAULT_PATH = "/tmp/cloudmaster-resolve.json"
+
+
+class ResolveCache(object):
+    """Resolved values keyed by name, persisted to path (if not None)"""
+
+    def __init__(self, ttl=DEFAULT_TTL, path=None, clock=time.time):
+        self.ttl = ttl
+        self.path = path
+        self._clock = clock
+        self._entries = None
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def _load(self):
+        # called with the lock held, the file is read on first use
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._entries = {k: tuple(v) for k, v in json.load(f).items()}
+            except (IOError, OSError, ValueError) as e:
+                print("ignoring resolve cache %s: %s" % (self.path, e))
+
+    def _save(self):
+        # called with the lock held, the file is replaced atomically
+        if not self.path:
+            return
+        now = self._clock()
+        entries = {k: v for k, v in self._entries.items() if v[1] > now}
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            print("can't save resolve cache %s: %s" % (self.path, e))
+
+    def get(self, name, resolve):
+        """Returns the value of name, calling resolve() when it is missing or expired.  Concurrent callers of the
+        same name wait for a single resolve(), its exceptions are raised to all of them and not cached"""
+
+        with self._lock:
+            self._load()
+            entry = self._entries.get(name)
+            if entry is not None and self._clock() < entry[1]:
+                return entry[0]
+            pending = self._pending.get(name)
+            owner = pending is None
+            if owner:
+                pending = self._pending[name] = {'done': threading.Event()}
+
+        if not owner:
+            pending['done'].wait()
+            if 'error' in pending:
+                raise pending['error']
+            return pending['value']
+
+        try:
+            value = resolve()
+        except Exception as e:
+            pending['error'] = e
+            raise
+        else:
+            pending['value'] = value
+            with self._lock:
+                self._entries[name] = (value, self._clock() + self.ttl)
+                self._save()
+            return value
+        finally:
+            with self._lock:
+                del self._pending[name]
+            pending['done'].set()
+
+    def invalidate(self, name=None):
+        """Drops the entry of name, or all entries if name is None"""
+
+        with self._lock:
+            self._load()
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+            self._save()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def from_config(config):
+    """Returns the resolve cache for a configuration (see module docs), the same one for equal configurations"""
+
+    key = json.dumps(config, sort_keys=True)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ResolveCache(ttl=config.get("ttl", DEFAULT_TTL),
+                                                path=config.get("path", DEFAULT_PATH))
+        return cache
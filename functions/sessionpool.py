@@ -0,0 +1,178 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Pool of authenticated vSphere sessions kept across warm function invocations.
+
+Logging in to vCenter is slow and vCenter limits the number of concurrent sessions, so instead of
+SmartConnect/Disconnect per command, sessions are kept in a pool keyed by host, port and user:
+
+* idle sessions are health checked (sessionManager.currentSession) before they are handed out, unless they were used
+  successfully within HEALTH_CHECK_INTERVAL seconds,
+* expired sessions are dropped and a new login is done,
+* at most max_sessions sessions are open per key, callers wait for a free one (up to timeout seconds).
+
+The pool does not depend on pyVmomi, connect and disconnect are passed in (SmartConnect and Disconnect in production,
+fakes in tests).
+"""
+
+import atexit
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
+MAX_SESSIONS = 4
+HEALTH_CHECK_INTERVAL = 60
+ACQUIRE_TIMEOUT = 30
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Session(object):
+    """Pooled session: the ServiceInstance and its (cached) service content"""
+
+    def __init__(self, key, si, content, checked_at):
+        self.key = key
+        self.si = si
+        self.content = content
+        self.checked_at = checked_at
+
+
+class SessionPool(object):
+    """Keeps logged in ServiceInstances, at most max_sessions per host and user"""
+
+    def __init__(self, connect, disconnect, max_sessions=MAX_SESSIONS,
+                 health_check_interval=HEALTH_CHECK_INTERVAL, clock=time.time):
+        self._connect = connect
+        self._disconnect = disconnect
+        self.max_sessions = max_sessions
+        self.health_check_interval = health_check_interval
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._open = {}
+
+    @staticmethod
+    def _key(host, port, user, pwd):
+        return host, port, user, hashlib.sha256(pwd.encode('utf-8')).hexdigest()
+
+    def _alive(self, session):
+        try:
+            return session.content.sessionManager.currentSession is not None
+        except Exception:
+            return False
+
+    def _login(self, key, host, port, user, pwd, connect_args):
+        si = self._connect(host=host, port=port, user=user, pwd=pwd, **connect_args)
+        try:
+            content = si.RetrieveContent()
+        except Exception:
+            self._disconnect(si)
+            raise
+        return Session(key, si, content, self._clock())
+
+    def _close(self, session):
+        try:
+            self._disconnect(session.si)
+        except Exception as e:
+            print("disconnect failed: %s" % e)
+
+    def acquire(self, host, port, user, pwd, timeout=ACQUIRE_TIMEOUT, **connect_args):
+        """Returns a live session, logging in if there is no idle one. Must be given back with release()"""
+
+        key = self._key(host, port, user, pwd)
+        deadline = self._clock() + timeout
+        while True:
+            with self._cond:
+                while not self._idle.get(key) and self._open.get(key, 0) >= self.max_sessions:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        raise PoolTimeout("no free vSphere session for %s@%s" % (user, host))
+                    self._cond.wait(remaining)
+                idle = self._idle.get(key)
+                session = idle.pop() if idle else None
+                if session is None:
+                    # reserve the slot before logging in outside of the lock
+                    self._open[key] = self._open.get(key, 0) + 1
+
+            if session is None:
+                try:
+                    session = self._login(key, host, port, user, pwd, connect_args)
+                except Exception:
+                    self._forget(key)
+                    raise
+                return session
+
+            if self._clock() - session.checked_at < self.health_check_interval or self._alive(session):
+                session.checked_at = self._clock()
+                return session
+
+            # expired, drop it and try again
+            self._close(session)
+            self._forget(key)
+
+    def release(self, session, healthy=True):
+        """Gives a session back to the pool. Unhealthy sessions are health checked on their next use"""
+
+        if not healthy:
+            session.checked_at = 0
+        with self._cond:
+            self._idle.setdefault(session.key, []).append(session)
+            self._cond.notify()
+
+    def discard(self, session):
+        """Logs out and drops a session"""
+
+        self._close(session)
+        self._forget(session.key)
+
+    def _forget(self, key):
+        with self._cond:
+            self._open[key] -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def session(self, host, port, user, pwd, **connect_args):
+        """Context manager around acquire() and release()"""
+
+        session = self.acquire(host, port, user, pwd, **connect_args)
+        try:
+            yield session
+        except Exception:
+            self.release(session, healthy=False)
+            raise
+        self.release(session)
+
+    def close_all(self):
+        """Logs out all idle sessions"""
+
+        with self._cond:
+            idle = [s for sessions in self._idle.values() for s in sessions]
+            for key, sessions in self._idle.items():
+                self._open[key] -= len(sessions)
+            self._idle.clear()
+            self._cond.notify_all()
+        for session in idle:
+            self._close(session)
+
+
+_pools = []
+
+
+def new_pool(connect, disconnect, **kwargs):
+    """Creates a pool whose idle sessions are logged out when the process exits"""
+
+    pool = SessionPool(connect, disconnect, **kwargs)
+    _pools.append(pool)
+    return pool
+
+
+@atexit.register
+def _close_pools():
+    for pool in _pools:
+        pool.close_all()
@@ -1,13 +1,33 @@
 import json
-import requests
 
+import metrics
+import poster
+
+
+def notifier(secrets):
+    """Returns a function posting messages to the slack status channel, used by other functions to report progress.
+    Messages are posted as digests (see poster.py), they are only printed if there is no statusUrl secret"""
+
+    status_url = secrets.get("statusUrl")
+
+    def _notify(msg):
+        print("status: %s" % msg)
+        if not status_url:
+            return
+        poster.for_url(status_url, secrets.get("statusDigest")).post(msg)
+
+    return _notify
+
+
+@metrics.instrumented('status')
 def handle(ctx, payload):
     secrets = ctx["secrets"]
 
     msg = payload.get("message")
     metadata = payload.setdefault("metadata", {})
     print(metadata)
+    if not msg:
+        return
 
-    resp = requests.post(secrets["statusUrl"], json={"text": msg})
-    if not resp.ok:
-        raise Exception("Post to slack failed[%s]: %s" % (resp.status_code, resp.text))
+    # events of a deployment wave are coalesced into digests instead of a post per event
+    poster.for_url(secrets["statusUrl"], secrets.get("statusDigest")).post(msg)
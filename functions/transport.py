@@ -0,0 +1,171 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Pooled HTTP transport shared by outbound calls (Dispatch API, slack response_url and webhooks).
+
+Module-level requests.post opens a new TCP (and TLS) connection for every call.  Sessions created here are kept per
+host for the life of the process, so warm function invocations reuse keep-alive connections.  Every session retries
+with exponential backoff and applies connect/read timeouts.  Requests are retried on connection errors (they never
+reached the server), idempotent ones on 429/5xx responses as well.  A POST may have been processed by a server
+answering 5xx, it is only retried on 429, after the response's Retry-After.
+
+Settings can be changed with configure(), e.g. from the "transport" entry of a secret:
+
+{
+  "transport": {
+    "pool_maxsize": 20,
+    "retries": 5,
+    "read_timeout": 120
+  }
+}
+"""
+
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from requests.packages.urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# methods retried on RETRY_STATUSES
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+DEFAULTS = {
+    "pool_connections": 4,
+    "pool_maxsize": 10,
+    "retries": 3,
+    "backoff_factor": 0.3,
+    "connect_timeout": 5.0,
+    "read_timeout": 60.0,
+}
+
+_settings = dict(DEFAULTS)
+_sessions = {}
+_lock = threading.Lock()
+
+
+def configure(**settings):
+    """Updates transport settings. Existing sessions are dropped only if the settings actually changed"""
+
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("unknown transport settings: %s" % ', '.join(sorted(unknown)))
+
+    with _lock:
+        updated = dict(_settings, **settings)
+        if updated == _settings:
+            return
+        _settings.update(updated)
+        _close_all()
+
+
+def reset():
+    """Restores default settings and closes all pooled sessions"""
+
+    with _lock:
+        _settings.clear()
+        _settings.update(DEFAULTS)
+        _close_all()
+
+
+def _close_all():
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
+
+
+class _Retry(Retry):
+    """Retries RETRY_METHODS on RETRY_STATUSES, other methods (POST) only on 429"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if not self._is_method_retryable(method):
+            return bool(self.total) and status_code == 429
+        return super(_Retry, self).is_retry(method, status_code, has_retry_after)
+
+
+def _retry(total):
+    kwargs = dict(
+        total=total,
+        # a request which timed out while reading may have been processed already, never resend it
+        read=0,
+        backoff_factor=_settings["backoff_factor"],
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    try:
+        return _Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return _Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+def _new_session(retries):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=_settings["pool_connections"],
+                          pool_maxsize=_settings["pool_maxsize"],
+                          max_retries=_retry(retries))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def session_for(url, retries=None):
+    """Returns the pooled session for the host of url (and number of retries, the configured one by default),
+    creating it on first use"""
+
+    if retries is None:
+        retries = _settings["retries"]
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc, retries)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _new_session(retries)
+                _sessions[key] = session
+    return session
+
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    """Sends a request through the pooled session of the url's host.
+
+    timeout defaults to the configured (connect, read) timeouts, a single number overrides the read timeout only.
+    retries overrides the configured number of retries, e.g. for calls with a deadline.
+    """
+
+    if timeout is None:
+        timeout = (_settings["connect_timeout"], _settings["read_timeout"])
+    elif not isinstance(timeout, tuple):
+        timeout = (_settings["connect_timeout"], timeout)
+    return session_for(url, retries).request(method, url, timeout=timeout, **kwargs)
+
+
+def not_sent(error):
+    """True if a request failed with error before it reached the server (it could not connect), so sending it again
+    can't apply it twice.  Read timeouts and connections dropped after the request was sent are not"""
+
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    # requests wraps urllib3's MaxRetryError, read timeouts included, in ConnectionError
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def post(url, **kwargs):
+    """Same as requests.post, but pooled"""
+
+    return request("POST", url, **kwargs)
+
+
+def get(url, **kwargs):
+    """Same as requests.get, but pooled"""
+
+    return request("GET", url, **kwargs)
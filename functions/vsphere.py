@@ -40,48 +40,57 @@ dispatch create base-image python3-base dispatchframework/python3-base:0.0.3 --l
 dispatch create image python-vsphere python3-base --runtime-deps requirements.txt
 
 Create a function:
-dispatch create function python-vsphere vsphere vsphere.py --secret vsphere
+dispatch create function python-vsphere vsphere . --handler vsphere.handle --secret vsphere
 
 Execute it:
 dispatch exec vsphere --wait --input='{"command": "create","name": "exampleVM"}'
 
 """
 
+import functools
 import json
 import ssl
+from concurrent.futures import ThreadPoolExecutor
 
 from pyVmomi import vim
 from pyVim.connect import SmartConnect, Disconnect
 
+import metrics
+import operations
+import sessionpool
+import status
+import vsphereinventory
+
+# logged in sessions are kept between invocations of a warm function
+POOL = sessionpool.new_pool(SmartConnect, Disconnect)
+
+# name -> moref index of the inventory, shared by invocations using the same session
+INDEX = vsphereinventory.InventoryIndex()
+
+TRACKER = operations.Tracker()
+
+# maximum number of Clone/Destroy tasks started concurrently
+MAX_PARALLEL_TASKS = 8
+
+COMMANDS = ('create', 'list', 'delete')
+
 
 def get_obj(content, vimtype, name):
     """Return an object by name, if name is None the
     first found object is returned
     """
-    obj = None
-    container = content.viewManager.CreateContainerView(
-        content.rootFolder, vimtype, True)
-    for c in container.view:
-        if name:
-            if c.name == name:
-                obj = c
-                break
-        else:
-            obj = c
-            break
-    return obj
-
-
-def list_vms(vm_folder):
+    for t in vimtype:
+        obj = INDEX.get(content, t, name)
+        if obj is not None:
+            return obj
+    return None
+
+
+def list_vms(content, vm_folder):
     """Returns a list of instances managed by cloudmaster"""
 
-    return [
-        {
-            'name': vm.summary.config.name,
-            'id': vm.summary.config.instanceUuid,
-            'status': vm.runtime.powerState,
-        }
-        for vm in vm_folder.childEntity]
+    with metrics.span('sdk', cloud='vsphere', call='RetrievePropertiesEx'):
+        return vsphereinventory.list_vms(content, vm_folder)
 
 
 def create_vm(content, template, vm_name, datacenter_name, vm_folder, resource_pool, power_on):
@@ -110,18 +119,41 @@ def create_vm(content, template, vm_name, datacenter_name, vm_folder, resource_p
 
     print("creating VM...")
     print("clone spec: %s" % clonespec)
-    task = template.Clone(folder=destfolder, name=vm_name, spec=clonespec)
-    return clonespec, task.info.state
+    with metrics.span('sdk', cloud='vsphere', call='Clone'):
+        task = template.Clone(folder=destfolder, name=vm_name, spec=clonespec)
+    return clonespec, task
 
 
 def delete_vm(content, name):
-    """Delete an instance"""
+    """Delete an instance, returns the result and the destroy task (None if there is no such VM)"""
     vm = get_obj(content, [vim.VirtualMachine], name)
+    task = None
     if vm:
-        vm.Destroy_Task()
+        with metrics.span('sdk', cloud='vsphere', call='Destroy_Task'):
+            task = vm.Destroy_Task()
+        INDEX.forget(vim.VirtualMachine, name)
     return {
         'status': 'vm deletion started'
-    }
+    }, task
+
+
+def in_parallel(func, names):
+    """Calls func(name) for all names concurrently, returns the results in order of names"""
+
+    with ThreadPoolExecutor(max_workers=min(len(names), MAX_PARALLEL_TASKS)) as executor:
+        return list(executor.map(func, names))
+
+
+def poll_task(task):
+    """Polls a vSphere task, returns (done, error)"""
+
+    with metrics.span('sdk', cloud='vsphere', call='task.info'):
+        info = task.info
+    if info.state == vim.TaskInfo.State.success:
+        return True, None
+    if info.state == vim.TaskInfo.State.error:
+        return True, info.error.msg if info.error else "task failed"
+    return False, None
 
 
 def _error(error_msg):
@@ -130,6 +162,7 @@ def _error(error_msg):
     })
 
 
+@metrics.instrumented('vsphere')
 def handle(ctx, payload):
     """entrypoint for vSphere operations"""
 
@@ -153,37 +186,53 @@ def handle(ctx, payload):
     if 'command' not in payload:
         return _error('command is required')
     command = payload['command']
+    if command not in COMMANDS:
+        # validated before a session to vCenter is used
+        return {"error": "command {} is not supported".format(command)}
+    # several VMs can be handled at once with "names", without a name the first VM found (e.g. the template) would be
+    # deleted
+    if command in ('create', 'delete') and not payload.get('name') and not payload.get('names'):
+        return _error('vm name is required')
 
-    # default result is unsupported command
-    result = {"error": "command {} is not supported".format(command)}
+    result = None
+    # several VMs can be created or deleted at once with "names"
+    names = payload.get("names") or [vm_name]
+    results, tasks = [], []
+
+    POOL.max_sessions = secrets.get("maxSessions", sessionpool.MAX_SESSIONS)
 
     context = None
     if hasattr(ssl, '_create_unverified_context'):
         context = ssl._create_unverified_context()
-    si = SmartConnect(
-        host=host,
-        user=username,
-        pwd=password,
-        port=port,
-        sslContext=context)
-
-    content = si.RetrieveContent()
-
-    if command == 'create':
-        template = get_obj(content, [vim.VirtualMachine], template_name)
-        if template is None:
-            _error("template not found")
-            return
-        _, result = create_vm(content, template, vm_name, dc_name, vm_folder, resource_pool, power_on)
-
-    if command == 'list':
-        folder = get_obj(content, [vim.Folder], vm_folder)
-        result = list_vms(folder)
-
-    if command == 'delete':
-        result = delete_vm(content, vm_name)
-
-    Disconnect(si)
+
+    with POOL.session(host, port, username, password, sslContext=context) as session:
+        content = session.content
+
+        if command == 'create':
+            template = get_obj(content, [vim.VirtualMachine], template_name)
+            if template is None:
+                _error("template not found")
+                return
+            tasks = in_parallel(
+                lambda name: create_vm(content, template, name, dc_name, vm_folder, resource_pool, power_on)[1],
+                names)
+            results = [{'status': 'vm creation started'} for _ in names]
+
+        if command == 'list':
+            folder = get_obj(content, [vim.Folder], vm_folder)
+            result = list_vms(content, folder)
+
+        if command == 'delete':
+            results, tasks = zip(*in_parallel(lambda name: delete_vm(content, name), names))
+
+    if command in ('create', 'delete'):
+        notify = status.notifier(secrets)
+        for name, r, task in zip(names, results, tasks):
+            if task is not None:
+                # the task keeps being polled on the pooled session after it is released
+                r['operation'] = operations.operation('vsphere', command, name, task._moId)
+                TRACKER.track(r['operation'], functools.partial(poll_task, task), notify)
+        result = list(results) if 'names' in payload else results[0]
 
     return result
 
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Event driven inventory of vSphere VMs managed by cloudmaster.
+
+The function is subscribed to VM lifecycle events of the vcenter event driver and applies them as deltas to an
+inventory.  It also answers the list command from that inventory, so listing vSphere does not poll vCenter.  The
+inventory is seeded (and re-synchronized every RESYNC_INTERVAL seconds, to correct for missed events) with a regular
+vSphere listing.  It is kept by an inventorycache backend, SQLite by default, so it survives restarts of the function.
+
+Handled events:
+
+* vm.cloned, vm.deployed: the VM is added
+* vm.being.cloned, vm.being.deployed: the VM is added as being deployed
+* vm.powered.on, vm.powered.off, vm.suspended: the status of a known VM is updated
+* vm.renamed: a known VM is renamed (from oldName, the event names the VM by its new name)
+* vm.removed: the VM is removed
+
+Like the seed (the VMs of the vmFolder), only VMs in the vmFolder are added.  Only vm.being.cloned events name the
+destination folder: VMs cloned elsewhere are ignored by the following events, VMs added by events without a folder
+are listed but re-checked by a re-synchronization on the next list.  Adding a known VM again (e.g. vm.cloned arriving
+after vm.powered.on) keeps its status.
+
+** REQUIREMENTS **
+
+Uses the vsphere secret, see vsphere.py.  An "inventory" entry configures the backend, see inventorycache.py (the
+"backend" defaults to "sqlite" here).
+
+Create a function:
+dispatch create function python-vsphere vsphere-inventory . --handler vsphereevents.handle --secret vsphere
+
+Replay recorded events (a JSON list of event payloads) locally:
+python vsphereevents.py events.json vsphere.json
+
+"""
+
+import json
+import threading
+import time
+
+import inventorycache
+
+RESYNC_INTERVAL = 60 * 60
+
+# the folder listed by the vsphere function without a vmFolder: the VM folder of the datacenter
+DEFAULT_FOLDER = 'vm'
+
+# the backend entry keeping the inventory
+BACKEND_KEY = 'vsphere-events'
+
+DEPLOYING = 'deploying'
+
+ADDED = {
+    'vm.cloned': 'poweredOff',
+    'vm.deployed': 'poweredOff',
+    'vm.being.cloned': DEPLOYING,
+    'vm.being.deployed': DEPLOYING,
+}
+
+STATUS = {
+    'vm.powered.on': 'poweredOn',
+    'vm.powered.off': 'poweredOff',
+    'vm.suspended': 'suspended',
+}
+
+
+def parse_event(payload):
+    """Returns (event type, event data) of an event delivered by Dispatch, either as a cloud event or as bare data"""
+
+    event_type = payload.get('eventType') or payload.get('eventtype') or payload.get('metadata', {}).get('eventType')
+    data = payload.get('data', payload)
+    if isinstance(data, str):
+        data = json.loads(data)
+    return event_type, data
+
+
+def _name(entity):
+    return (entity or {}).get('name')
+
+
+class EventInventory(object):
+    """Materialized inventory of cloudmaster VMs, keyed by name, kept by an inventorycache backend"""
+
+    def __init__(self, backend=None, folder=DEFAULT_FOLDER, clock=time.time):
+        self.backend = backend or inventorycache.MemoryBackend()
+        self.folder = folder
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._vms = None
+        # VMs added by events which don't name their folder, and VMs cloned into other folders
+        self._unverified = set()
+        self._outside = set()
+        self.synced_at = None
+
+    def _load(self):
+        # called with the lock held, the backend is read on first use
+        if self._vms is not None:
+            return
+        self._vms = {}
+        entry = self.backend.get(BACKEND_KEY)
+        if entry is not None:
+            state, synced_at = entry
+            self._vms = {name: dict(vm) for name, vm in state['vms'].items()}
+            self._unverified = set(state['unverified'])
+            self._outside = set(state.get('outside', ()))
+            self.synced_at = synced_at or None
+
+    def _save(self):
+        # called with the lock held
+        state = {'vms': self._vms, 'unverified': sorted(self._unverified), 'outside': sorted(self._outside)}
+        self.backend.put(BACKEND_KEY, state, self.synced_at or 0)
+
+    def seed(self, vms):
+        """Replaces the inventory with a full listing"""
+
+        with self._lock:
+            self._vms = {vm['name']: dict(vm) for vm in vms}
+            self._unverified = set()
+            self._outside = set()
+            self.synced_at = self._clock()
+            self._save()
+
+    def needs_sync(self, interval=RESYNC_INTERVAL):
+        """True if the inventory was not synchronized within interval seconds, or has VMs to re-check"""
+
+        with self._lock:
+            self._load()
+            return bool(self._unverified) or self.synced_at is None or self._clock() - self.synced_at > interval
+
+    def _matches(self, data, name):
+        # the filter of the seed: False for VMs it doesn't list, None if it can't be told from the event
+        folder = _name(data.get('destFolder'))
+        if folder is None:
+            return False if name in self._outside else None
+        return folder == self.folder
+
+    def _add(self, event_type, data, name, ref):
+        # called with the lock held
+        matches = self._matches(data, name)
+        if matches is False:
+            if name in self._vms or name in self._outside:
+                return False
+            self._outside.add(name)
+            return True
+        entry = self._vms.get(name)
+        if entry is None:
+            self._vms[name] = {'name': name, 'id': ref, 'status': ADDED[event_type]}
+            if matches is None:
+                self._unverified.add(name)
+            return True
+
+        changed = False
+        if entry['status'] == DEPLOYING and ADDED[event_type] != DEPLOYING:
+            # only a deployment finishing sets the status, a VM powered on (or off) meanwhile keeps it
+            entry['status'] = ADDED[event_type]
+            changed = True
+        if matches and name in self._unverified:
+            self._unverified.discard(name)
+            changed = True
+        return changed
+
+    def _rename(self, data, name):
+        # called with the lock held, the event names the VM by its new name
+        old_name = data.get('oldName')
+        new_name = data.get('newName') or name
+        if not old_name or old_name == new_name:
+            return False
+        if old_name in self._outside:
+            self._outside.discard(old_name)
+            self._outside.add(new_name)
+            return True
+        if old_name not in self._vms:
+            return False
+        entry = self._vms.pop(old_name)
+        entry['name'] = new_name
+        self._vms[new_name] = entry
+        if old_name in self._unverified:
+            self._unverified.discard(old_name)
+            self._unverified.add(new_name)
+        return True
+
+    def _update(self, event_type, data, name):
+        # called with the lock held
+        if event_type == 'vm.renamed':
+            return self._rename(data, name)
+        if event_type == 'vm.removed' and name in self._outside:
+            self._outside.discard(name)
+            return True
+        if name not in self._vms:
+            # not managed by cloudmaster
+            return False
+        if event_type in STATUS:
+            self._vms[name]['status'] = STATUS[event_type]
+            return True
+        if event_type == 'vm.removed':
+            del self._vms[name]
+            self._unverified.discard(name)
+            return True
+        return False
+
+    def apply(self, event_type, data):
+        """Applies an event, returns True if the inventory changed"""
+
+        vm = data.get('vm') or {}
+        name = vm.get('name')
+        if not event_type or not name:
+            return False
+
+        with self._lock:
+            self._load()
+            if event_type in ADDED:
+                changed = self._add(event_type, data, name, (vm.get('vm') or {}).get('value'))
+            else:
+                changed = self._update(event_type, data, name)
+            if changed:
+                self._save()
+            return changed
+
+    def list(self):
+        with self._lock:
+            self._load()
+            return sorted((dict(vm) for vm in self._vms.values()), key=lambda vm: vm['name'])
+
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def inventory_for(secrets):
+    """Returns the inventory of the vmFolder of a vsphere secret, kept by the backend of its "inventory" entry"""
+
+    config = dict({'backend': 'sqlite'}, **secrets.get('inventory', {}))
+    folder = secrets.get('vmFolder') or DEFAULT_FOLDER
+    key = json.dumps([config, folder], sort_keys=True)
+    with _inventories_lock:
+        inventory = _inventories.get(key)
+        if inventory is None:
+            inventory = _inventories[key] = EventInventory(inventorycache.backend(config), folder=folder)
+        return inventory
+
+
+def _sync(ctx, inventory):
+    # imported here, the event path does not need pyVmomi
+    import vsphere
+    vms = vsphere.handle(ctx, {'command': 'list'})
+    if isinstance(vms, list):
+        inventory.seed(vms)
+
+
+def handle(ctx, payload):
+    """entrypoint for vcenter events and the list command"""
+
+    inventory = inventory_for(ctx['secrets'])
+    if payload.get('command') == 'list':
+        if inventory.needs_sync(ctx['secrets'].get('resyncInterval', RESYNC_INTERVAL)):
+            _sync(ctx, inventory)
+        return inventory.list()
+
+    event_type, data = parse_event(payload)
+    return {'applied': inventory.apply(event_type, data)}
+
+
+if __name__ == "__main__":
+    import sys
+
+    with open(sys.argv[1]) as p:
+        events = json.load(p)
+
+    with open(sys.argv[2]) as s:
+        secrets = json.load(s)
+    ctx = {
+        "secrets": secrets
+    }
+    # replayed events are applied to an empty inventory, without polling vCenter
+    inventory = inventory_for(secrets)
+    inventory.seed([])
+    for event in events:
+        print("event: ", event, file=sys.stderr)
+        print(handle(ctx, event), file=sys.stderr)
+    print(json.dumps(inventory.list(), indent=2), file=sys.stdout)
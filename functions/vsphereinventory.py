@@ -0,0 +1,153 @@
+#######################################################################
+# Copyright (c) 2018 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#######################################################################
+
+"""
+Bulk inventory lookups for vSphere based on the PropertyCollector.
+
+Walking a ContainerView and reading .name of every object costs one round-trip per object.  InventoryIndex instead
+fetches the names of all objects of the indexed types with a single RetrieveContents call and keeps a name -> moref
+dictionary per type for TTL seconds.  Container views are destroyed as soon as the properties are retrieved.
+
+list_vms() reads the properties of all VMs in a folder the same way, in pages of PAGE_SIZE objects
+(RetrievePropertiesEx/ContinueRetrievePropertiesEx), instead of lazily reading every property of every VM.
+"""
+
+import time
+
+from pyVmomi import vim, vmodl
+
+DEFAULT_TTL = 5 * 60
+PAGE_SIZE = 500
+
+INDEXED_TYPES = [vim.VirtualMachine, vim.Datacenter, vim.Folder, vim.ResourcePool]
+
+PropertyCollector = vmodl.query.PropertyCollector
+
+VM_PROPERTIES = ['summary.config.name', 'summary.config.instanceUuid', 'runtime.powerState']
+
+
+def view_filter_spec(view, vimtypes, paths):
+    """Returns a filter spec selecting paths of all objects of vimtypes in a container view"""
+
+    traversal = PropertyCollector.TraversalSpec(name='traverseEntities', path='view', skip=False,
+                                                type=vim.view.ContainerView)
+    obj_spec = PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_specs = [PropertyCollector.PropertySpec(type=t, pathSet=paths, all=False) for t in vimtypes]
+    return PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+
+
+def folder_filter_spec(folder, vimtype, paths):
+    """Returns a filter spec selecting paths of the direct children of folder which are of vimtype"""
+
+    traversal = PropertyCollector.TraversalSpec(name='traverseChildren', path='childEntity', skip=False,
+                                                type=vim.Folder)
+    obj_spec = PropertyCollector.ObjectSpec(obj=folder, skip=True, selectSet=[traversal])
+    prop_spec = PropertyCollector.PropertySpec(type=vimtype, pathSet=paths, all=False)
+    return PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+
+
+def retrieve_properties(collector, filter_spec, page_size=PAGE_SIZE):
+    """Yields (moref, {path: value}) for all objects selected by filter_spec, page_size objects per round-trip"""
+
+    options = PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    result = collector.RetrievePropertiesEx([filter_spec], options)
+    token = None
+    try:
+        while result is not None:
+            token = result.token
+            for obj_content in result.objects:
+                yield obj_content.obj, {p.name: p.val for p in obj_content.propSet}
+            if not token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token)
+        token = None
+    finally:
+        if token:
+            # the caller stopped early, release the server side result set
+            collector.CancelRetrievePropertiesEx(token)
+
+
+def list_vms(content, folder, page_size=PAGE_SIZE):
+    """Returns name, id and status of all VMs in folder"""
+
+    spec = folder_filter_spec(folder, vim.VirtualMachine, VM_PROPERTIES)
+    return [
+        {
+            'name': props.get('summary.config.name'),
+            'id': props.get('summary.config.instanceUuid'),
+            'status': props.get('runtime.powerState'),
+        }
+        for _, props in retrieve_properties(content.propertyCollector, spec, page_size)]
+
+
+def retrieve_names(content, vimtypes):
+    """Returns (moref, name) of all objects of vimtypes under the root folder using a single round-trip"""
+
+    view = content.viewManager.CreateContainerView(content.rootFolder, vimtypes, True)
+    try:
+        result = content.propertyCollector.RetrieveContents([view_filter_spec(view, vimtypes, ['name'])])
+    finally:
+        view.Destroy()
+
+    return [(obj_content.obj, obj_content.propSet[0].val) for obj_content in result if obj_content.propSet]
+
+
+class InventoryIndex(object):
+    """Name -> moref dictionaries of the inventory, refreshed in bulk every ttl seconds"""
+
+    def __init__(self, vimtypes=None, ttl=DEFAULT_TTL, clock=time.time):
+        self.vimtypes = vimtypes or INDEXED_TYPES
+        self.ttl = ttl
+        self._clock = clock
+        self._content = None
+        self._expires = 0
+        self._index = {}
+
+    def refresh(self, content):
+        """Rebuilds the index from the inventory"""
+
+        index = {t: {} for t in self.vimtypes}
+        for obj, name in retrieve_names(content, self.vimtypes):
+            for t in self.vimtypes:
+                if isinstance(obj, t):
+                    # like a view scan, the first object found with a name wins
+                    index[t].setdefault(name, obj)
+        self._index = index
+        self._content = content
+        self._expires = self._clock() + self.ttl
+
+    def _fresh(self, content):
+        return content is self._content and self._clock() < self._expires
+
+    def get(self, content, vimtype, name):
+        """Returns an object of vimtype by name, if name is None the first found object is returned.
+
+        An unknown name refreshes the index once (the object may have been created after the last refresh).
+        """
+
+        refreshed = False
+        if not self._fresh(content):
+            self.refresh(content)
+            refreshed = True
+
+        objects = self._index.get(vimtype)
+        if objects is None:
+            raise KeyError("%s is not indexed" % vimtype.__name__)
+        if not name:
+            return next(iter(objects.values()), None)
+
+        obj = objects.get(name)
+        if obj is None and not refreshed:
+            self.refresh(content)
+            obj = self._index[vimtype].get(name)
+        return obj
+
+    def forget(self, vimtype, name):
+        """Drops an object which is known to be gone (e.g. after it was destroyed)"""
+
+        self._index.get(vimtype, {}).pop(name, None)
+
+    def invalidate(self):
+        self._expires = 0